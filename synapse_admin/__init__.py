@@ -9,5 +9,6 @@ from synapse_admin.user import User  # noqa: F401
 from synapse_admin.management import Management  # noqa: F401
 from synapse_admin.media import Media  # noqa: F401
 from synapse_admin.room import Room  # noqa: F401
+from synapse_admin.mirror import Mirror  # noqa: F401
 import synapse_admin.base as base  # noqa: F401
 Mgt = Management  # Alias
@@ -21,14 +21,18 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE."""
 
 import httpx
+import json
 import os
 import re
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from configparser import ConfigParser
 from datetime import datetime
 from getpass import getpass
 from pathlib import Path
 from stat import S_IREAD, S_IWRITE
-from typing import Tuple, Any, Union
+from typing import Tuple, Any, Callable, Iterable, Iterator, NamedTuple, Union
 
 
 class SynapseException(Exception):
@@ -43,12 +47,112 @@ class SynapseException(Exception):
         return f"SynapseException: [{self.code}] {self.msg}"
 
 
-class Utility():
+class _MimeMap(dict):
+    """dict rebuilding the lookup tables of Utility.guess_type on change"""
+
+    def __setitem__(self, magic: bytes, mime: str) -> None:
+        super().__setitem__(magic, mime)
+        _compile_signatures()
+
+    def __delitem__(self, magic: bytes) -> None:
+        super().__delitem__(magic)
+        _compile_signatures()
+
+    def __ior__(self, other: dict) -> "_MimeMap":
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs) -> None:
+        super().update(*args, **kwargs)
+        _compile_signatures()
+
+    def setdefault(self, magic: bytes, mime: str = None) -> str:
+        mime = super().setdefault(magic, mime)
+        _compile_signatures()
+        return mime
+
+    def pop(self, *args) -> str:
+        mime = super().pop(*args)
+        _compile_signatures()
+        return mime
+
+    def popitem(self) -> Tuple[bytes, str]:
+        item = super().popitem()
+        _compile_signatures()
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        _compile_signatures()
+
+
+class _UtilityType(type):
+    """Rebuild the lookup tables of Utility.guess_type when a new mime_map or
+    mime_signatures is assigned"""
+
+    def __setattr__(cls, name: str, value: Any) -> None:
+        if name == "mime_map" and not isinstance(value, _MimeMap):
+            value = _MimeMap(value)
+        super().__setattr__(name, value)
+        if name in ("mime_map", "mime_signatures"):
+            _compile_signatures()
+
+
+class Utility(metaclass=_UtilityType):
     """Some utilities"""
 
     port_re = re.compile(r":[0-9]{1,5}/?$")
     http_re = re.compile(r"^https?://")
-    mime_map = {
+    # (offset, magic, mime type, extra checks). An extra check is a pair of
+    # (offset, bytes), offset None means anywhere within the sniffed header.
+    mime_signatures = (
+        (0, b"\xff\xd8\xff", "image/jpeg", ()),
+        (0, b"\x89PNG\r\n\x1a\n", "image/png", ()),
+        (0, b"GIF87a", "image/gif", ()),
+        (0, b"GIF89a", "image/gif", ()),
+        (0, b"BM", "image/bmp", ()),
+        (0, b"II*\x00", "image/tiff", ()),
+        (0, b"MM\x00*", "image/tiff", ()),
+        (0, b"\x00\x00\x00\x0cjP  \r\n\x87\n", "image/jp2", ()),
+        (0, b"RIFF", "image/webp", ((8, b"WEBP"),)),
+        (0, b"RIFF", "audio/wav", ((8, b"WAVE"),)),
+        (0, b"RIFF", "video/x-msvideo", ((8, b"AVI "),)),
+        (4, b"ftyp", "image/heic", ((8, b"heic"),)),
+        (4, b"ftyp", "image/heic", ((8, b"heix"),)),
+        (4, b"ftyp", "image/heif", ((8, b"mif1"),)),
+        (4, b"ftyp", "image/heif", ((8, b"msf1"),)),
+        (4, b"ftyp", "image/avif", ((8, b"avif"),)),
+        (4, b"ftyp", "video/quicktime", ((8, b"qt  "),)),
+        (4, b"ftyp", "audio/mp4", ((8, b"M4A "),)),
+        (4, b"ftyp", "video/3gpp", ((8, b"3gp"),)),
+        (4, b"ftyp", "video/mp4", ()),
+        (0, b"\x1a\x45\xdf\xa3", "video/x-matroska", ((None, b"matroska"),)),
+        (0, b"\x1a\x45\xdf\xa3", "video/webm", ()),
+        (0, b"OggS", "audio/opus", ((28, b"OpusHead"),)),
+        (0, b"OggS", "video/ogg", ((28, b"\x80theora"),)),
+        (0, b"OggS", "audio/ogg", ()),
+        (0, b"OpusHead", "audio/opus", ()),
+        (0, b"fLaC", "audio/flac", ()),
+        (0, b"ID3", "audio/mpeg", ()),
+        (0, b"\xff\xfb", "audio/mpeg", ()),
+        (0, b"\xff\xf3", "audio/mpeg", ()),
+        (0, b"\xff\xf2", "audio/mpeg", ()),
+        (0, b"\xff\xf1", "audio/aac", ()),
+        (0, b"\xff\xf9", "audio/aac", ()),
+        (0, b"%PDF-", "application/pdf", ()),
+        (0, b"PK\x03\x04", "application/zip", ()),
+        (0, b"PK\x05\x06", "application/zip", ()),
+        (0, b"PK\x07\x08", "application/zip", ()),
+        (0, b"\x1f\x8b", "application/gzip", ()),
+        (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed", ()),
+        (0, b"Rar!\x1a\x07", "application/vnd.rar", ()),
+        (0, b"wOFF", "font/woff", ()),
+        (0, b"wOF2", "font/woff2", ()),
+    )
+    sniff_length = 64
+    # Magics at offset 0 without extra check, tried before mime_signatures.
+    # Changing it, or assigning a new dict, takes effect immediately.
+    mime_map = _MimeMap({
         b"\xff\xd8": "image/jpeg", b"\x42\x4D": "image/bmp",
         b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A": "image/png",
         b"\x49\x49\x2A\x00": "image/tiff", b"\x4D\x4D\x00\x2A": "image/tiff",
@@ -59,7 +163,7 @@ class Utility():
         b"\x4F\x70\x75\x73\x48\x65\x61\x64": "audio/opus",
         b"\x1A\x45\xDF\xA3": "video/webm",
         b"\x66\x74\x79\x70\x69\x73\x6F\x6D": "video/mp4",
-    }
+    })
 
     @staticmethod
     def get_bool(boolean: bool) -> str:
@@ -114,7 +218,12 @@ class Utility():
 
     @staticmethod
     def guess_type(stream: bytes) -> str:
-        """Provide very limited guesses on the mime type base on the magic of the stream  # noqa: E501
+        """Guess the mime type base on the magic of the stream
+
+        Only the first Utility.sniff_length bytes are inspected. Signatures are
+        looked up by their offset and leading byte, see Utility.mime_map and
+        Utility.mime_signatures. Magics at offset 0 are tried first, other
+        offsets only on a miss.
 
         Args:
             stream (bytes): the stream
@@ -122,12 +231,207 @@ class Utility():
         Returns:
             str: mime type
         """
-        for magic, mime in Utility.mime_map.items():
-            num = len(magic)
-            if stream[:num] == magic:
-                return mime
+        leading, offsets = _signature_tables
+        try:
+            for magic, mime, checks in leading.get(stream[0], ()):
+                # Most magics have no extra check, they are matched inline
+                if stream.startswith(magic) and (
+                    not checks or _match_checks(stream, checks)
+                ):
+                    return mime
+            for offset, index in offsets:
+                if len(stream) > offset:
+                    for magic, mime, checks in index.get(stream[offset], ()):
+                        if stream.startswith(magic, offset) and (
+                            not checks or _match_checks(stream, checks)
+                        ):
+                            return mime
+        except IndexError:  # empty stream
+            return None
+        except AttributeError:  # no startswith, e.g. memoryview
+            return Utility.guess_type(bytes(stream[:Utility.sniff_length]))
+        return None
+
+    @staticmethod
+    def is_success(result: Any) -> bool:
+        """Determine whether a value returned by a wrapper method means success
+
+        Args:
+            result (Any): the returned value
+
+        Returns:
+            bool: False if the result is None, False or a suppressed exception
+        """
+        if result is None or result is False:
+            return False
+        if isinstance(result, tuple) and len(result) > 0:
+            return result[0] is not False
+        return True
+
+    @staticmethod
+    def _retry_after(result: Any) -> float:
+        """Get the time to wait from a suppressed M_LIMIT_EXCEEDED error
+
+        Args:
+            result (Any): the returned value of a wrapper method
+
+        Returns:
+            float: seconds to wait, or None if the result is not rate limited
+        """
+        if not isinstance(result, tuple) or Utility.is_success(result):
+            return None
+        for detail in result[1:]:
+            if isinstance(detail, dict):
+                if detail.get("errcode") == "M_LIMIT_EXCEEDED":
+                    return detail.get("retry_after_ms", 1000) / 1000
+            elif detail == "M_LIMIT_EXCEEDED":
+                return 1.0
         return None
 
+    @staticmethod
+    def _retry_delay(outcome: Any, attempt: int) -> float:
+        """Get the time to wait before retrying a rate limited call
+
+        Args:
+            outcome (Any): the returned value or the raised exception of the call
+            attempt (int): number of retries done so far
+
+        Returns:
+            float: seconds to wait, or None if the call is not rate limited
+        """
+        if isinstance(outcome, SynapseException):
+            if outcome.code != "M_LIMIT_EXCEEDED":
+                return None
+            # The exception does not carry retry_after_ms, back off instead
+            return 2.0 ** attempt
+        return Utility._retry_after(outcome)
+
+    @staticmethod
+    def _call_with_retry(func: Callable, item: Any, retries: int) -> Any:
+        """Call func with item, retry if the homeserver is rate limiting us
+
+        Args:
+            func (Callable): the function to be called
+            item (Any): the argument to pass to func
+            retries (int): maximum number of retries
+
+        Returns:
+            Any: the returned value of func
+        """
+        backoff = 1.0
+        for attempt in range(retries + 1):
+            try:
+                result = func(item)
+            except SynapseException as e:
+                if e.code != "M_LIMIT_EXCEEDED" or attempt == retries:
+                    raise
+                delay = backoff
+            else:
+                delay = Utility._retry_after(result)
+                if delay is None or attempt == retries:
+                    return result
+            time.sleep(delay)
+            backoff *= 2
+
+    @staticmethod
+    def concurrent_map(
+        func: Callable,
+        items: Iterable,
+        workers: int = 8,
+        retries: int = 3
+    ) -> Iterator["Outcome"]:
+        """Call func on every item with a bounded number of threads
+
+        Items are consumed lazily, at most twice the number of workers are in
+        flight, so the iterable can be a generator of any length. A call that is
+        rate limited (M_LIMIT_EXCEEDED) sleeps and retries in its own thread
+        while the other threads keep going.
+
+        Args:
+            func (Callable): function taking one item
+            items (Iterable): the items
+            workers (int, optional): maximum number of concurrent calls. Defaults to 8.
+            retries (int, optional): maximum number of retries when rate limited. Defaults to 3. # noqa: E501
+
+        Yields:
+            Outcome: item, success, returned value or raised exception, in completion order # noqa: E501
+        """
+        if workers < 1:
+            raise ValueError("Argument 'workers' must be a positive integer")
+        iterator = iter(items)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while iterator is not None and len(pending) < workers * 2:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        iterator = None
+                        break
+                    future = executor.submit(
+                        Utility._call_with_retry,
+                        func,
+                        item,
+                        retries
+                    )
+                    pending[future] = item
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        yield Outcome(item, False, e)
+                    else:
+                        yield Outcome(item, Utility.is_success(result), result)
+
+
+def _compile_signatures() -> tuple:
+    """Build the lookup tables used by Utility.guess_type
+
+    Utility.mime_map and Utility.mime_signatures are grouped by offset and then
+    by the first byte of the magic. Within a group, the ones with more extra
+    checks and longer magic come first so that the generic fallback of a
+    container format is tried last, mime_map wins between equal ones.
+
+    Returns:
+        tuple: the group of offset 0, and (offset, group) pairs for the others
+    """
+    global _signature_tables
+    signatures = [
+        (0, magic, mime, ()) for magic, mime in Utility.mime_map.items()
+    ]
+    signatures.extend(Utility.mime_signatures)
+    index = {}
+    # sorted is stable in reverse too, mime_map stays ahead of equal ones
+    ordered = sorted(
+        signatures,
+        key=lambda sig: (len(sig[3]), len(sig[1])),
+        reverse=True
+    )
+    for offset, magic, mime, checks in ordered:
+        group = index.setdefault(offset, {})
+        group.setdefault(magic[0], []).append((magic, mime, checks))
+    leading = index.pop(0, {})
+    _signature_tables = (leading, tuple(sorted(index.items())))
+    return _signature_tables
+
+
+def _match_checks(stream: bytes, checks: tuple) -> bool:
+    end = Utility.sniff_length
+    for offset, expected in checks:
+        if offset is None:
+            if stream.find(expected, 0, end) < 0:
+                return False
+        elif not stream.startswith(expected, offset, end):
+            return False
+    return True
+
+
+_signature_tables = _compile_signatures()
+
 
 class _BaseContents():
     """Base class for Contents"""
@@ -162,6 +466,203 @@ class Contents(list, _BaseContents):
         super(Contents, self).__init__(data)
 
 
+class Outcome(NamedTuple):
+    """Result of one item processed by Utility.concurrent_map"""
+    item: Any
+    success: bool
+    result: Any
+
+
+class TimeSlicer():
+    """Split a time range into successive windows, oldest first
+
+    After a window is processed, its duration is passed to record and the
+    next window is scaled so that it should take about target_duration,
+    by at most a factor of two each time. position is the start of the
+    first window not processed yet, a slicer created with it as start_ts
+    resumes the work.
+    """
+
+    def __init__(
+        self,
+        start_ts: int,
+        end_ts: int,
+        window: int,
+        target_duration: float,
+        min_window: int = 60000,
+        max_window: int = None
+    ):
+        """
+        Args:
+            start_ts (int): start of the range in milliseconds
+            end_ts (int): end of the range in milliseconds
+            window (int): size of the first window in milliseconds
+            target_duration (float): seconds a window should take
+            min_window (int, optional): minimum window size in milliseconds. Defaults to 60000. # noqa: E501
+            max_window (int, optional): maximum window size in milliseconds. Defaults to None (unbounded). # noqa: E501
+        """
+        if window <= 0 or target_duration <= 0:
+            raise ValueError(
+                "Argument 'window' and 'target_duration' must be positive"
+            )
+        self.position = start_ts
+        self.end_ts = end_ts
+        self.window = window
+        self.target_duration = target_duration
+        self.min_window = min_window
+        self.max_window = max_window
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        while self.position < self.end_ts:
+            until = min(self.position + int(self.window), self.end_ts)
+            yield self.position, until
+            self.position = until
+
+    def record(self, duration: float) -> None:
+        """Scale the next window by the duration of the last one
+
+        Args:
+            duration (float): seconds the last window took
+        """
+        if duration > 0:
+            factor = min(max(self.target_duration / duration, 0.5), 2.0)
+        else:
+            factor = 2.0
+        window = max(self.window * factor, self.min_window)
+        if self.max_window is not None:
+            window = min(window, self.max_window)
+        self.window = window
+
+
+class PersistentIndex():
+    """Base of the indexes kept in memory and saved to a JSON file
+
+    Subclasses reset their content in _reset, convert it to and from
+    JSON-serializable data in _dump and _restore, and may override _open
+    to change the file format.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path (str, optional): a file to load from and save to. Defaults to None. # noqa: E501
+        """
+        self.path = path
+        self._reset()
+        if path is not None and os.path.isfile(path):
+            self.load(path)
+
+    def _reset(self) -> None:
+        pass
+
+    def _dump(self) -> Any:
+        raise NotImplementedError
+
+    def _restore(self, data: Any) -> None:
+        raise NotImplementedError
+
+    @staticmethod
+    def _open(path: str, mode: str):
+        return open(path, mode, encoding="utf8")
+
+    def save(self, path: str = None) -> bool:
+        """Write the index to a file
+
+        Args:
+            path (str, optional): the file. Defaults to None (the path of the index). # noqa: E501
+
+        Returns:
+            bool: success or not
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("Argument 'path' must be specified")
+        with self._open(path, "wt") as f:
+            json.dump(self._dump(), f, separators=(",", ":"))
+        return True
+
+    def load(self, path: str = None) -> bool:
+        """Read the index from a file written by save
+
+        Args:
+            path (str, optional): the file. Defaults to None (the path of the index). # noqa: E501
+
+        Returns:
+            bool: success or not
+        """
+        path = path or self.path
+        with self._open(path, "rt") as f:
+            data = json.load(f)
+        self._reset()
+        self._restore(data)
+        return True
+
+
+class BipartiteIndex(PersistentIndex):
+    """Base of the two-sided indexes between keys and their values
+
+    Keys and values are interned as integers, the values of a key and the
+    keys of a value are stored as arrays of those integers.
+    """
+
+    def _reset(self) -> None:
+        self._keys, self._key_ids = [], {}
+        self._values, self._value_ids = [], {}
+        self._key_values = {}
+        self._value_keys = {}
+
+    @staticmethod
+    def _intern(value: str, values: list, ids: dict) -> int:
+        index = ids.get(value)
+        if index is None:
+            index = ids[value] = len(values)
+            values.append(value)
+        return index
+
+    def _link(self, key: str, values: Iterable) -> int:
+        self._unlink(key)
+        k = self._intern(key, self._keys, self._key_ids)
+        indices = array("L")
+        for value in values:
+            v = self._intern(value, self._values, self._value_ids)
+            indices.append(v)
+            self._value_keys.setdefault(v, array("L")).append(k)
+        self._key_values[k] = indices
+        return k
+
+    def _unlink(self, key: str) -> int:
+        k = self._key_ids.get(key)
+        if k is None or k not in self._key_values:
+            return None
+        for v in self._key_values.pop(k):
+            keys = self._value_keys[v]
+            keys.remove(k)
+            if not keys:
+                del self._value_keys[v]
+        return k
+
+    def _linked_keys(self) -> list:
+        return [self._keys[k] for k in self._key_values]
+
+    def _values_of(self, key: str) -> list:
+        indices = self._key_values.get(self._key_ids.get(key), ())
+        return [self._values[v] for v in indices]
+
+    def _keys_of(self, value: str) -> list:
+        indices = self._value_keys.get(self._value_ids.get(value), ())
+        return [self._keys[k] for k in indices]
+
+    def _dump_links(self) -> Tuple[list, dict]:
+        # Only values still linked are written, renumbered from zero
+        values, value_ids, links = [], {}, {}
+        for k, indices in self._key_values.items():
+            links[self._keys[k]] = [
+                self._intern(self._values[v], values, value_ids)
+                for v in indices
+            ]
+        return values, links
+
+
 class Admin():
     """Base class for storing common variable read configuration"""
 
@@ -589,6 +1090,63 @@ class Admin():
             uri = uri.split("/")[-1]
         return uri
 
+    def _paginate(
+        self,
+        method: Callable,
+        from_arg: str = "_from",
+        read_ahead: bool = False,
+        **kwargs: Any
+    ) -> Iterator:
+        """Iterate over every item returned by a paginated admin API
+
+        Args:
+            method (Callable): a method returning Contents, e.g. User.lists
+            from_arg (str, optional): name of the argument taking the next token. Defaults to "_from". # noqa: E501
+            read_ahead (bool, optional): fetch the next page in a thread while the current one is consumed. Defaults to False. # noqa: E501
+            **kwargs: other arguments passed to the method on every call
+
+        Yields:
+            Any: items of each page
+
+        Raises:
+            SynapseException: a page failed, even if exceptions are suppressed,
+                so that a failure is never mistaken for the end of the listing
+        """
+        def fetch(token: Union[str, int]) -> Contents:
+            page = method(**{from_arg: token}, **kwargs)
+            if page is None:  # e.g. event_reports with no report
+                return Contents([], 0, None)
+            if not isinstance(page, Contents):
+                if isinstance(page, tuple) and len(page) == 3:
+                    # (False, errcode, error)
+                    raise SynapseException(page[1], page[2])
+                data = page[-1] if isinstance(page, tuple) else page
+                if isinstance(data, dict):
+                    raise SynapseException(
+                        data.get("errcode"),
+                        data.get("error")
+                    )
+                raise SynapseException(None, str(data))
+            return page
+
+        if not read_ahead:
+            token = 0
+            while True:
+                page = fetch(token)
+                yield from page
+                if not page or not page.next:
+                    return
+                token = page.next
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch, 0)
+            while future is not None:
+                page = future.result()
+                future = None
+                if page and page.next:
+                    future = executor.submit(fetch, page.next)
+                yield from page
+
 
 class Client(httpx.Client):
     """Some custom behavior based on httpx.Client"""
@@ -67,7 +67,8 @@ class ClientAPI(Admin):
         invite: Union[str, list] = None,
         federation: bool = True,
         encrypted: bool = True,
-        room_type: str = None
+        room_type: str = None,
+        retry: bool = True
     ) -> str:
         """Create a room as a client
 
@@ -79,6 +80,7 @@ class ClientAPI(Admin):
             federation (bool, optional): allow federation. Defaults to True.
             encrypted (bool, optional): create encrypted room or not. Defaults to True
             room_type: (str, optional): type of room to create
+            retry (bool, optional): wait and retry when rate limited, otherwise the M_LIMIT_EXCEEDED error is returned or raised. Defaults to True. # noqa: E501
 
         Returns:
             str: created room id
@@ -118,17 +120,17 @@ class ClientAPI(Admin):
                 f"{ClientAPI.BASE_PATH}/createRoom",
                 json=data
             )
-            data = resp.json()
-            if "errcode" in data and data["errcode"] == "M_LIMIT_EXCEEDED":
-                time.sleep(data["retry_after_ms"] / 1000)
+            result = resp.json()
+            if retry and result.get("errcode") == "M_LIMIT_EXCEEDED":
+                time.sleep(result["retry_after_ms"] / 1000)
                 continue
             if resp.status_code == 200:
-                return data["room_id"]
+                return result["room_id"]
             else:
                 if self.suppress_exception:
-                    return False, data
+                    return False, result
                 else:
-                    raise SynapseException(data["errcode"], data["error"])
+                    raise SynapseException(result["errcode"], result["error"])
 
     def client_leave_room(self, roomid: str) -> bool:
         """leave a room as a client
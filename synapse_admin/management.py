@@ -19,11 +19,20 @@ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
 LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE."""
+import hashlib
+import heapq
 import os
+import time
+from collections import Counter
+from datetime import datetime
 from synapse_admin import User
-from synapse_admin.base import Admin, SynapseException, Contents
+from synapse_admin.base import (
+    Admin, BipartiteIndex, SynapseException, Contents, PersistentIndex,
+    TimeSlicer, Utility
+)
 from synapse_admin.client import ClientAPI
-from typing import NamedTuple, Union, Tuple
+from synapse_admin.room import Room
+from typing import Any, Callable, Iterable, NamedTuple, Union, Tuple
 
 
 class Management(Admin):
@@ -43,6 +52,23 @@ class Management(Admin):
         server: str
         python: str
 
+    class PurgeResult(NamedTuple):
+        status: str
+        purge_id: str
+        duration: float
+        error: Any
+
+    class FederationHealth(NamedTuple):
+        classes: dict
+        worst: list
+        total: int
+
+    class SlicedPurge(NamedTuple):
+        windows: list
+        position: int
+        complete: bool
+        error: Any
+
     def __init__(
         self,
         server_addr=None,
@@ -73,9 +99,18 @@ class Management(Admin):
                 server_protocol,
                 suppress_exception
             )
+            self.room = Room(
+                server_addr,
+                server_port,
+                access_token,
+                server_protocol,
+                suppress_exception
+            )
         else:
             self.user = User()
             self.client = ClientAPI()
+            self.room = Room()
+        self._attachments = {}
         self._create_alias()
 
     def _create_alias(self) -> None:
@@ -88,17 +123,30 @@ class Management(Admin):
     ) -> Tuple[str, str, str]:
         """Upload a media and return its information
 
+        A media is uploaded once per handler, the same content is looked up
+        by its SHA-256 digest and the previous media id is reused.
+
         Args:
             attachment (Union[str, bytes]): the media, either in str or bytes
 
         Returns:
             Tuple[str, str, str]: media id, message type defined in matrix, file name  # noqa: E501
         """
-        mediaid, mime = self.client.client_upload_attachment(attachment)
         if isinstance(attachment, bytes):
+            digest = hashlib.sha256(attachment).hexdigest()
             filename = "unknown"
-        else:
+        elif isinstance(attachment, str):
+            with open(attachment, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
             filename = os.path.basename(attachment)
+        else:
+            raise TypeError("Argument attachment must be str or bytes")
+        uploaded = self._attachments.get(digest)
+        if uploaded is None:
+            uploaded = self.client.client_upload_attachment(attachment)
+            if Utility.is_success(uploaded):
+                self._attachments[digest] = uploaded
+        mediaid, mime = uploaded
         if "image/" in mime:
             msgtype = "m.image"
         elif "video/" in mime:
@@ -110,12 +158,24 @@ class Management(Admin):
 
         return mediaid, msgtype, filename
 
+    def _attachment_content(self, attachment: Union[str, bytes]) -> dict:
+        """Upload a media and build the content of its message
+
+        Args:
+            attachment (Union[str, bytes]): the media, either in str or bytes
+
+        Returns:
+            dict: the content of the message
+        """
+        mediaid, msgtype, filename = self._prepare_attachment(attachment)
+        return {"body": filename, "msgtype": msgtype, "url": mediaid}
+
     def announce(
         self,
         userid: Union[str, bool],
         announcement: str = None,
         attachment: Union[str, bytes] = None
-    ) -> Union[str, list]:
+    ) -> Union[str, list, dict]:
         """Send an announcement to a user or a batch of users
 
         Args:
@@ -124,42 +184,32 @@ class Management(Admin):
             attachment (Union[str, bytes], optional): the media you want to send or to attach. Either provide a path to the file or the stream. Defaults to None.
 
         Returns:
-            Union[str, list]: if either announcement or attachment is specified, return the event id
+            Union[str, list, dict]: if either announcement or attachment is specified, return the event id
                 if both announcement and attachment are specified, return a list which contains the event id for the attachment and the text
+                if userid is True, return a dict with user id as key and the above as value
         """
-        if isinstance(userid, str):
-            invoking_method = self._announce
-        elif isinstance(userid, bool) and userid:
-            invoking_method = self.announce_all
-            raise ValueError("Argument must be a non-empty str or True")
         if announcement is None and attachment is None:
             raise ValueError(
                 "You must at least specify "
                 "announcement or attachment"
             )
+        if userid is True:
+            return self.announce_all(announcement, attachment=attachment)
+        if not isinstance(userid, str) or not userid:
+            raise ValueError("Argument must be a non-empty str or True")
         userid = self.validate_username(userid)
-        if attachment is not None:
-            mediaid, msgtype, filename = self._prepare_attachment(
-                attachment
-            )
-            data = {
-                "user_id": userid,
-                "content": {
-                    "body": filename,
-                    "msgtype": msgtype,
-                    "url": mediaid
-                }
-            }
-            if announcement is not None:
-                event_ids = []
-                event_ids.append(invoking_method(userid, "", data))
-                event_ids.append(invoking_method(userid, announcement))
-                return event_ids
-            else:
-                announcement = ""
-        elif announcement is not None:
-            data = None
-        return invoking_method(userid, announcement, data)
+        if attachment is None:
+            return self._announce(userid, announcement)
+        data = {
+            "user_id": userid,
+            "content": self._attachment_content(attachment)
+        }
+        if announcement is None:
+            return self._announce(userid, "", data)
+        return [
+            self._announce(userid, "", data),
+            self._announce(userid, announcement)
+        ]
 
     def _announce(
         self,
@@ -202,22 +252,115 @@ class Management(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
-    def announce_all(self, announcement: str, data: dict = None) -> dict:
+    def announce_all(
+        self,
+        announcement: str,
+        data: dict = None,
+        workers: int = 8,
+        checkpoint: str = None,
+        include_bots: bool = False,
+        limit: int = 500,
+        attachment: Union[str, bytes] = None
+    ) -> dict:
         """Send an announcement to all local users
 
+        Users are listed page by page and notified concurrently. Deactivated
+        users, guests and, unless include_bots is set, bot and support users
+        are skipped. With a checkpoint file, every notified user is appended
+        to the file and skipped when the broadcast is run again, so an
+        interrupted broadcast can be resumed without notifying anyone twice.
+
+        An attachment is uploaded once and its message is sent to each user
+        right before the text announcement.
+
         Args:
-            announcement (str): the announcement
+            announcement (str): the announcement, can be None if an attachment is specified # noqa: E501
+            data (dict, optional): the request body to send instead of a text announcement, its user_id is replaced for every user. Defaults to None. # noqa: E501
+            workers (int, optional): number of concurrent notices. Defaults to 8.
+            checkpoint (str, optional): path to the checkpoint file. Defaults to None.
+            include_bots (bool, optional): whether to notify bot and support users. Defaults to False. # noqa: E501
+            limit (int, optional): number of users listed per page. Defaults to 500.
+            attachment (Union[str, bytes], optional): the media you want to send or to attach. Either provide a path to the file or the stream. Defaults to None. # noqa: E501
 
         Returns:
-            dict: a dict with user id as key and the event id as value
+            dict: a dict with user id as key and the event id (or the error) as value
+                If both announcement and attachment are specified, the value is a list which contains the event id (or the error) for the attachment and the text.
+                Users notified in a previous run are not included. A user is written to the checkpoint only when every message was delivered.
         """
-        events = {}
-        for user in self.user.lists():
-            events[user["name"]] = self._announce(
-                user["name"],
-                announcement,
-                data
+        if announcement is None and attachment is None and data is None:
+            raise ValueError(
+                "You must at least specify "
+                "announcement or attachment"
+            )
+        content = None
+        if attachment is not None:
+            content = self._attachment_content(attachment)
+        notified = set()
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            with open(checkpoint, "r", encoding="utf8") as f:
+                notified = {line.strip() for line in f if line.strip()}
+
+        def recipients():
+            for user in self._paginate(
+                self.user.lists,
+                from_arg="offset",
+                limit=limit,
+                guests=False,
+                deactivated=False
+            ):
+                if (user.get("deactivated") or user.get("is_guest")
+                        or user["name"] in notified):
+                    continue
+                if not include_bots and user.get("user_type") is not None:
+                    continue
+                yield user["name"]
+
+        def send(userid: str) -> Union[str, list]:
+            if data is not None:
+                return self._announce(userid, "", {**data, "user_id": userid})
+            if content is None:
+                return self._announce(userid, announcement)
+            event = self._announce(
+                userid,
+                "",
+                {"user_id": userid, "content": content}
+            )
+            if announcement is None or not Utility.is_success(event):
+                return event
+            # Retry the text alone and never raise past this point, otherwise
+            # concurrent_map would retry send and post the attachment again
+            try:
+                text = Utility._call_with_retry(
+                    lambda text: self._announce(userid, text),
+                    announcement,
+                    3
+                )
+            except SynapseException as e:
+                text = e
+            return [event, text]
+
+        def delivered(result: Union[str, list]) -> bool:
+            parts = result if isinstance(result, list) else [result]
+            return all(
+                Utility.is_success(part)
+                and not isinstance(part, Exception)
+                for part in parts
             )
+
+        events = {}
+        log = None
+        if checkpoint is not None:
+            log = open(checkpoint, "a", encoding="utf8")
+        try:
+            for outcome in Utility.concurrent_map(send, recipients(), workers):
+                events[outcome.item] = outcome.result
+                if (log is not None and outcome.success
+                        and delivered(outcome.result)):
+                    log.write(f"{outcome.item}\n")
+                    log.flush()
+        finally:
+            if log is not None:
+                log.close()
         return events
 
     def version(self) -> SynapseVersion:
@@ -300,6 +443,176 @@ class Management(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def _wait_purge(self, purge_id: str, poll_interval: float) -> str:
+        """Poll a purge job until it is no longer active
+
+        Args:
+            purge_id (str): the purge id you want to wait for
+            poll_interval (float): seconds between two polls
+
+        Returns:
+            str: the final status of the purge job
+        """
+        while True:
+            status = self.purge_history_status(purge_id)
+            if status != "active":
+                return status
+            time.sleep(poll_interval)
+
+    def purge_history_sliced(
+        self,
+        roomid: str,
+        before_ts: int,
+        include_local_event: bool = False,
+        window: int = 86400000,
+        target_duration: float = 30.0,
+        poll_interval: float = 1.0,
+        start_ts: int = None
+    ) -> SlicedPurge:
+        """Purge old events in a room in successive time windows, oldest first
+
+        Every window is purged by its own purge job, which is waited for
+        before the next one starts. Each window is sized from the duration of
+        the previous one, so that every job takes about target_duration.
+
+        Args:
+            roomid (str): the room you want to perform the purging
+            before_ts (int): purge events older than this timestamp in milliseconds
+            include_local_event (bool, optional): whether to purge local events. Defaults to False. # noqa: E501
+            window (int, optional): size of the first window in milliseconds. Defaults to 86400000 (a day). # noqa: E501
+            target_duration (float, optional): seconds a purge job should take. Defaults to 30.0. # noqa: E501
+            poll_interval (float, optional): seconds between two polls. Defaults to 1.0.
+            start_ts (int, optional): where to start, e.g. the position of an interrupted run. Defaults to None (the creation of the room). # noqa: E501
+
+        Returns:
+            SlicedPurge: windows: (end of window, purge id, duration) of every purged window,
+                position: timestamp up to which the room is purged,
+                complete: whether everything before before_ts was purged, error: the error if any
+        """
+        if start_ts is None:
+            state = self.room.get_state(roomid)
+            if not Utility.is_success(state):
+                return Management.SlicedPurge([], None, False, state)
+            start_ts = next(
+                event["origin_server_ts"] for event in state
+                if event["type"] == "m.room.create"
+            )
+        slicer = TimeSlicer(start_ts, before_ts, window, target_duration)
+        windows = []
+        for _, until in slicer:
+            started = time.monotonic()
+            try:
+                purgeid = self.purge_history(
+                    roomid,
+                    until,
+                    include_local_event
+                )
+                status = purgeid
+                if isinstance(purgeid, str):
+                    status = self._wait_purge(purgeid, poll_interval)
+            except SynapseException as e:
+                status = e
+            if status != "complete":
+                return Management.SlicedPurge(
+                    windows, slicer.position, False, status
+                )
+            duration = time.monotonic() - started
+            windows.append((until, purgeid, duration))
+            slicer.record(duration)
+        return Management.SlicedPurge(windows, slicer.position, True, None)
+
+    def purge_history_all(
+        self,
+        before_ts: int,
+        rooms: Iterable[str] = None,
+        include_local_event: bool = False,
+        concurrency: int = 2,
+        max_concurrency: int = 16,
+        target_duration: float = 60.0,
+        poll_interval: float = 1.0,
+        limit: int = 500
+    ) -> dict:
+        """Purge the history of many rooms with a bounded number of purges in flight
+
+        All running purges are polled in one loop. The number of purges in
+        flight grows by one every time as many purges as are in flight finish
+        within target_duration, and is halved when a purge takes longer or
+        fails, so the load on the database follows how fast it copes.
+
+        Args:
+            before_ts (int): purge events older than this timestamp in milliseconds
+            rooms (Iterable[str], optional): rooms to purge. Defaults to None (all rooms). # noqa: E501
+            include_local_event (bool, optional): whether to purge local events. Defaults to False. # noqa: E501
+            concurrency (int, optional): initial number of purges in flight. Defaults to 2. # noqa: E501
+            max_concurrency (int, optional): maximum number of purges in flight. Defaults to 16. # noqa: E501
+            target_duration (float, optional): seconds a purge may take before the concurrency is reduced. Defaults to 60.0. # noqa: E501
+            poll_interval (float, optional): seconds between two polls. Defaults to 1.0.
+            limit (int, optional): number of rooms listed per page. Defaults to 500. # noqa: E501
+
+        Returns:
+            dict: a dict with room id as key and PurgeResult as value,
+                status: "complete", "failed" or "error" (the purge could not be started),
+                purge_id, duration: seconds from start to the final status, error: the error if any
+        """
+        if rooms is None:
+            rooms = (
+                room["room_id"]
+                for room in self._paginate(self.room.lists, limit=limit)
+            )
+        rooms = iter(rooms)
+        window = float(max(1, min(concurrency, max_concurrency)))
+        active, results = {}, {}
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < int(window):
+                roomid = next(rooms, None)
+                if roomid is None:
+                    exhausted = True
+                    break
+                try:
+                    purgeid = Utility._call_with_retry(
+                        lambda roomid: self.purge_history(
+                            roomid,
+                            before_ts,
+                            include_local_event
+                        ),
+                        roomid,
+                        3
+                    )
+                except SynapseException as e:
+                    purgeid = e
+                if isinstance(purgeid, str):
+                    active[purgeid] = (roomid, time.monotonic())
+                else:
+                    results[roomid] = Management.PurgeResult(
+                        "error", None, 0.0, purgeid
+                    )
+            if not active:
+                return results
+
+            time.sleep(poll_interval)
+            for purgeid, (roomid, started) in list(active.items()):
+                try:
+                    status = self.purge_history_status(purgeid)
+                except SynapseException as e:
+                    status = e
+                if status == "active":
+                    continue
+                del active[purgeid]
+                duration = time.monotonic() - started
+                if status == "complete":
+                    results[roomid] = Management.PurgeResult(
+                        status, purgeid, duration, None
+                    )
+                else:
+                    results[roomid] = Management.PurgeResult(
+                        "failed", purgeid, duration, status
+                    )
+                if status == "complete" and duration <= target_duration:
+                    window = min(window + 1 / int(window), max_concurrency)
+                else:
+                    window = max(window / 2, 1.0)
+
     def event_reports(
         self,
         limit: int = 100,
@@ -374,6 +687,49 @@ class Management(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def triage_event_reports(
+        self,
+        index: "EventReportIndex",
+        workers: int = 8,
+        limit: int = 100
+    ) -> list:
+        """Fetch the details of new event reports and add them to an index
+
+        Reports are listed from the newest and the listing stops at the newest
+        report already in the index. The details of the new reports are fetched
+        concurrently. Reports whose details failed to be fetched are retried
+        on the next run.
+
+        Args:
+            index (EventReportIndex): the index holding the reports seen so far
+            workers (int, optional): number of reports fetched concurrently. Defaults to 8. # noqa: E501
+            limit (int, optional): number of reports listed per page. Defaults to 100. # noqa: E501
+
+        Returns:
+            list: details of the new reports, sorted by report id
+        """
+        reportids = set(index.pending)
+        for report in self._paginate(self.event_reports, limit=limit):
+            if report["id"] <= index.last_id:
+                break
+            reportids.add(report["id"])
+        index.last_id = max(reportids, default=index.last_id)
+
+        reports, index.pending = [], []
+        for outcome in Utility.concurrent_map(
+            self.specific_event_report,
+            reportids,
+            workers
+        ):
+            if outcome.success and Utility.is_success(outcome.result):
+                index.add(outcome.result)
+                reports.append(outcome.result)
+            else:
+                index.pending.append(outcome.item)
+        if index.path is not None:
+            index.save()
+        return sorted(reports, key=lambda report: report["id"])
+
     def delete_group(self, groupid: str) -> bool:
         """Delete a local group
 
@@ -573,6 +929,146 @@ class Management(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def federation_health(
+        self,
+        dead_after: int = 604800000,
+        top: int = 10,
+        limit: int = 500,
+        now: int = None
+    ) -> FederationHealth:
+        """Classify all remote destinations by their retry timing
+
+        Destinations are paged with the next page fetched while the current
+        one is being classified. The retry timing is part of every listed
+        destination, so no per-destination request is needed.
+
+        Args:
+            dead_after (int, optional): milliseconds of failure after which a destination is considered dead. Defaults to 604800000 (a week). # noqa: E501
+            top (int, optional): number of failing destinations in the summary. Defaults to 10. # noqa: E501
+            limit (int, optional): number of destinations listed per page. Defaults to 500. # noqa: E501
+            now (int, optional): the current time in millisecond. Defaults to None (Utility.get_current_time()). # noqa: E501
+
+        Returns:
+            FederationHealth: classes: a dict with "healthy", "backoff" (waiting for the next retry),
+                "retrying" (failing but allowed to retry) and "dead" (failing longer than dead_after) as key
+                and a list of destinations as value,
+                worst: (destination, milliseconds since the first failure, retry interval) of
+                the destinations failing for the longest time, total: number of destinations
+        """
+        if now is None:
+            now = Utility.get_current_time()
+        classes = {"healthy": [], "backoff": [], "retrying": [], "dead": []}
+        failing = []
+        for destination in self._paginate(
+            self.federation_list,
+            read_ahead=True,
+            limit=limit
+        ):
+            name = destination["destination"]
+            failure_ts = destination.get("failure_ts")
+            retry_last_ts = destination.get("retry_last_ts") or 0
+            retry_interval = destination.get("retry_interval") or 0
+            if failure_ts is None and retry_interval == 0:
+                classes["healthy"].append(name)
+                continue
+            failing_for = now - failure_ts if failure_ts else 0
+            failing.append((name, failing_for, retry_interval))
+            if failure_ts is not None and failing_for > dead_after:
+                classes["dead"].append(name)
+            elif retry_last_ts + retry_interval > now:
+                classes["backoff"].append(name)
+            else:
+                classes["retrying"].append(name)
+        worst = heapq.nlargest(top, failing, key=lambda item: item[1:])
+        return Management.FederationHealth(
+            classes,
+            worst,
+            sum(len(destinations) for destinations in classes.values())
+        )
+
+    def reset_connections(
+        self,
+        destinations: Iterable[str],
+        workers: int = 8
+    ) -> list:
+        """Reset the connection timeout for many destinations concurrently
+
+        Args:
+            destinations (Iterable[str]): the remote destinations
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+
+        Returns:
+            list: a list of Outcome, one for each destination
+        """
+        return list(Utility.concurrent_map(
+            self.reset_connection,
+            destinations,
+            workers
+        ))
+
+    def federation_room_map(
+        self,
+        index: Union["FederationRoomMap", str] = None,
+        full: bool = False,
+        workers: int = 8,
+        limit: int = 500
+    ) -> "FederationRoomMap":
+        """Build or refresh an index of the rooms shared with every destination
+
+        Without full, only destinations that are new or whose details
+        (retry timing and last successful stream ordering) changed since the
+        last refresh are crawled. Destinations that are no longer listed are
+        dropped.
+
+        Args:
+            index (Union[FederationRoomMap, str], optional): an index or a path to load and save it. Defaults to None (new index). # noqa: E501
+            full (bool, optional): crawl all destinations again. Defaults to False.
+            workers (int, optional): number of destinations crawled concurrently. Defaults to 8. # noqa: E501
+            limit (int, optional): number of items fetched per page. Defaults to 500.
+
+        Returns:
+            FederationRoomMap: the updated index, saved to its path if it has one
+        """
+        if not isinstance(index, FederationRoomMap):
+            index = FederationRoomMap(index)
+        fingerprints = {
+            destination["destination"]: [
+                destination.get(key) for key in FederationRoomMap.FINGERPRINT
+            ]
+            for destination in self._paginate(
+                self.federation_list,
+                read_ahead=True,
+                limit=limit
+            )
+        }
+        for destination in index.destinations():
+            if destination not in fingerprints:
+                index.remove(destination)
+        targets = [
+            destination for destination, fingerprint in fingerprints.items()
+            if full or index.fingerprints.get(destination) != fingerprint
+        ]
+
+        def crawl(destination: str) -> list:
+            return [
+                room["room_id"] for room in self._paginate(
+                    self.federation_room,
+                    destination=destination,
+                    limit=limit
+                )
+            ]
+
+        for outcome in Utility.concurrent_map(crawl, targets, workers):
+            if outcome.success:
+                index.update(
+                    outcome.item,
+                    outcome.result,
+                    fingerprints[outcome.item]
+                )
+        if index.path is not None:
+            index.save()
+        return index
+
     def federation_room(
         self,
         destination: str,
@@ -613,3 +1109,326 @@ class Management(Admin):
                 return False, data["errcode"], data["error"]
             else:
                 raise SynapseException(data["errcode"], data["error"])
+
+
+class EventReportIndex(PersistentIndex):
+    """Counts of event reports by reported user, room and reporter
+
+    Only the counts are kept, not the reports. The newest report id indexed
+    is remembered, as report ids only grow, so that a later run only fetches
+    newer reports.
+    """
+
+    def _reset(self) -> None:
+        self.last_id = 0
+        self.pending = []
+        self.senders = Counter()
+        self.rooms = Counter()
+        self.reporters = Counter()
+        self.events = Counter()
+        self.scores = Counter()
+        self.sender_scores = {}
+
+    def __len__(self) -> int:
+        return sum(self.reporters.values())
+
+    def add(self, report: dict) -> None:
+        """Count a report
+
+        Args:
+            report (dict): the report returned by Management.specific_event_report # noqa: E501
+        """
+        sender = report.get("sender")
+        score = report.get("score")
+        self.senders[sender] += 1
+        self.rooms[report["room_id"]] += 1
+        self.reporters[report["user_id"]] += 1
+        self.events[report["event_id"]] += 1
+        self.scores[score] += 1
+        self.sender_scores.setdefault(sender, Counter())[score] += 1
+
+    def score_distribution(self, userid: str = None) -> Counter:
+        """Count the reports by score
+
+        Args:
+            userid (str, optional): only count the reports against this user. Defaults to None (all reports). # noqa: E501
+
+        Returns:
+            Counter: score as key and number of reports as value
+        """
+        if userid is None:
+            return Counter(self.scores)
+        return Counter(self.sender_scores.get(userid, {}))
+
+    def _dump(self) -> dict:
+        return {
+            "last_id": self.last_id,
+            "pending": self.pending,
+            "senders": self.senders,
+            "rooms": self.rooms,
+            "reporters": self.reporters,
+            "events": self.events,
+            # JSON keys are strings, scores are kept as pairs
+            "scores": list(self.scores.items()),
+            "sender_scores": {
+                sender: list(scores.items())
+                for sender, scores in self.sender_scores.items()
+            }
+        }
+
+    def _restore(self, data: dict) -> None:
+        self.last_id, self.pending = data["last_id"], data["pending"]
+        for name in ("senders", "rooms", "reporters", "events"):
+            getattr(self, name).update(data[name])
+        self.scores.update(dict(data["scores"]))
+        self.sender_scores = {
+            sender: Counter(dict(scores))
+            for sender, scores in data["sender_scores"].items()
+        }
+
+
+class FederationRoomMap(BipartiteIndex):
+    """Bipartite index between remote destinations and the rooms shared with them
+
+    Destinations are the keys and room ids the values of the index, the
+    fingerprint of every destination is kept to detect changes.
+    """
+
+    FINGERPRINT = (
+        "retry_last_ts", "retry_interval", "failure_ts",
+        "last_successful_stream_ordering"
+    )
+
+    def _reset(self) -> None:
+        super()._reset()
+        self.fingerprints = {}
+
+    def __len__(self) -> int:
+        return len(self._key_values)
+
+    def __contains__(self, destination: str) -> bool:
+        return self._key_ids.get(destination) in self._key_values
+
+    def update(self, destination: str, rooms: list, fingerprint: list) -> None:
+        """Replace the rooms shared with a destination
+
+        Args:
+            destination (str): the remote destination
+            rooms (list): room ids shared with the destination
+            fingerprint (list): the details of the destination when it was crawled # noqa: E501
+        """
+        self._link(destination, rooms)
+        self.fingerprints[destination] = fingerprint
+
+    def remove(self, destination: str) -> None:
+        """Remove a destination from the index
+
+        Args:
+            destination (str): the remote destination
+        """
+        self.fingerprints.pop(destination, None)
+        self._unlink(destination)
+
+    def destinations(self) -> list:
+        """List all indexed destinations
+
+        Returns:
+            list: remote destinations
+        """
+        return self._linked_keys()
+
+    def rooms_of(self, destination: str) -> list:
+        """List the rooms shared with a destination
+
+        Args:
+            destination (str): the remote destination
+
+        Returns:
+            list: room ids
+        """
+        return self._values_of(destination)
+
+    def destinations_in(self, roomid: str) -> list:
+        """List the destinations participating in a room
+
+        Args:
+            roomid (str): the room
+
+        Returns:
+            list: remote destinations
+        """
+        return self._keys_of(roomid)
+
+    def counts(self) -> Counter:
+        """Count the rooms shared with every destination
+
+        Returns:
+            Counter: destination as key and number of rooms as value
+        """
+        return Counter({
+            self._keys[server]: len(rooms)
+            for server, rooms in self._key_values.items()
+        })
+
+    def _dump(self) -> dict:
+        rooms, links = self._dump_links()
+        destinations = {
+            destination: [self.fingerprints[destination], indices]
+            for destination, indices in links.items()
+        }
+        return {"rooms": rooms, "destinations": destinations}
+
+    def _restore(self, data: dict) -> None:
+        rooms = data["rooms"]
+        for destination, (fingerprint, indices) in (
+            data["destinations"].items()
+        ):
+            self.update(destination, [rooms[i] for i in indices], fingerprint)
+
+
+class BackgroundUpdateMonitor():
+    """Sample the background updates of a homeserver and estimate their progress
+
+    The rate of an update is computed from the items processed between two
+    samples. The total number of items of an update is not reported by the
+    homeserver, so the ETA is only known for updates whose expected total is
+    given. Background updates can be restricted to maintenance windows, they
+    are enabled inside a window and disabled outside.
+    """
+
+    class UpdateProgress(NamedTuple):
+        name: str
+        items: int
+        rate: float
+        eta: float
+        stalled: bool
+
+    def __init__(
+        self,
+        management: Management,
+        expected: dict = None,
+        stall_after: float = 300.0,
+        windows: list = None
+    ):
+        """
+        Args:
+            management (Management): the handler used to query the homeserver
+            expected (dict, optional): a dict with update name as key and its expected number of items as value. Defaults to None. # noqa: E501
+            stall_after (float, optional): seconds without progress after which an update is stalled. Defaults to 300.0. # noqa: E501
+            windows (list, optional): (start, end) pairs of datetime.time in local time, a window may span midnight. Defaults to None (never toggle). # noqa: E501
+        """
+        self.management = management
+        self.expected = expected or {}
+        self.stall_after = stall_after
+        self.windows = windows
+        self.enabled = None
+        self._last = {}
+
+    @staticmethod
+    def _checked(result: Any) -> Any:
+        # A failure is raised even if the handler suppresses exceptions, it
+        # would otherwise be taken for the state of the updates. Successful
+        # results may be False too, failures are (False, errcode, error).
+        if (isinstance(result, tuple) and len(result) == 3
+                and result[0] is False):
+            raise SynapseException(result[1], result[2])
+        return result
+
+    def in_window(self, now: datetime = None) -> bool:
+        """Determine whether a time is inside a maintenance window
+
+        Args:
+            now (datetime, optional): the time. Defaults to None (now).
+
+        Returns:
+            bool: inside a window or not, always True without windows
+        """
+        if not self.windows:
+            return True
+        current = (now or datetime.now()).time()
+        for start, end in self.windows:
+            if start <= end and start <= current < end:
+                return True
+            if start > end and (current >= start or current < end):
+                return True
+        return False
+
+    def apply_window(self, now: datetime = None) -> bool:
+        """Enable or disable background updates according to the windows
+
+        Args:
+            now (datetime, optional): the time. Defaults to None (now).
+
+        Returns:
+            bool: whether background updates should be enabled
+        """
+        wanted = self.in_window(now)
+        if self.windows and wanted != self.enabled:
+            self.enabled = self._checked(
+                self.management.background_updates_set(wanted)
+            )
+        return wanted
+
+    def sample(self) -> dict:
+        """Query the background updates and estimate their progress
+
+        Returns:
+            dict: a dict with database name as key and UpdateProgress as value
+
+        Raises:
+            SynapseException: the query failed, even if exceptions are suppressed
+        """
+        enabled, updates = self._checked(
+            self.management.background_updates_get()
+        )
+        self.enabled = enabled
+        now = time.monotonic()
+        progress = {}
+        for database, update in updates.items():
+            name, items = update["name"], update["total_item_count"]
+            last = self._last.get(database)
+            if last is None or last[0] != name:
+                last = self._last[database] = [name, items, now, now]
+            rate = update.get("average_items_per_ms", 0) * 1000
+            if now > last[2]:
+                rate = (items - last[1]) / (now - last[2])
+            if items != last[1] or not enabled:
+                last[3] = now
+            last[1], last[2] = items, now
+            eta = None
+            if name in self.expected and rate > 0:
+                eta = max(self.expected[name] - items, 0) / rate
+            stalled = now - last[3] >= self.stall_after
+            progress[database] = BackgroundUpdateMonitor.UpdateProgress(
+                name, items, rate, eta, stalled
+            )
+        for database in set(self._last) - set(updates):
+            del self._last[database]
+        return progress
+
+    def run(
+        self,
+        interval: float = 10.0,
+        samples: int = None,
+        callback: Callable = None
+    ) -> dict:
+        """Sample repeatedly until no background update is running
+
+        Args:
+            interval (float, optional): seconds between two samples. Defaults to 10.0.
+            samples (int, optional): maximum number of samples. Defaults to None (unlimited). # noqa: E501
+            callback (Callable, optional): called with the result of every sample. Defaults to None. # noqa: E501
+
+        Returns:
+            dict: the last sample
+        """
+        count = 0
+        while True:
+            self.apply_window()
+            progress = self.sample()
+            count += 1
+            if callback is not None:
+                callback(progress)
+            if not progress or (samples is not None and count >= samples):
+                return progress
+            time.sleep(interval)
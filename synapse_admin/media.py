@@ -20,8 +20,16 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE."""
 
-from synapse_admin.base import Admin, SynapseException, Utility, Contents
-from typing import NamedTuple, Union
+import heapq
+import json
+import os
+import time
+from synapse_admin import User
+from synapse_admin.base import (
+    Admin, BipartiteIndex, SynapseException, TimeSlicer, Utility, Contents
+)
+from synapse_admin.room import Room
+from typing import Any, Callable, Iterable, NamedTuple, Tuple, Union
 
 
 class Media(Admin):
@@ -39,6 +47,36 @@ class Media(Admin):
         local: list
         remote: list
 
+    class UsageReport(NamedTuple):
+        from_ts: int
+        until_ts: int
+        users: int
+        media_count: int
+        media_length: int
+        top_length: list
+        top_count: list
+        length_histogram: dict
+        count_histogram: dict
+
+    class RetentionPlan(NamedTuple):
+        before_ts: int
+        size_gt: int
+        media: dict
+        count: int
+        length: int
+
+    class RetentionReport(NamedTuple):
+        deleted: list
+        failed: list
+        length: int
+
+    class SlicedDeletion(NamedTuple):
+        deleted: int
+        media: list
+        position: int
+        complete: bool
+        error: Any
+
     def __init__(
         self,
         server_addr=None,
@@ -54,6 +92,24 @@ class Media(Admin):
             server_protocol,
             suppress_exception
         )
+        if server_addr is not None and access_token is not None:
+            self.user = User(
+                server_addr,
+                server_port,
+                access_token,
+                server_protocol,
+                suppress_exception
+            )
+            self.room = Room(
+                server_addr,
+                server_port,
+                access_token,
+                server_protocol,
+                suppress_exception
+            )
+        else:
+            self.user = User()
+            self.room = Room()
         self._create_alias()
 
     def _create_alias(self) -> None:
@@ -133,6 +189,101 @@ class Media(Admin):
             data.get("next_token", None)
         )
 
+    def usage_report(
+        self,
+        top: int = 10,
+        from_ts: int = None,
+        until_ts: int = None,
+        limit: int = 500
+    ) -> UsageReport:
+        """Summarize the media usage of all users
+
+        Every page of Media.statistics is consumed as it arrives, only the top
+        users and the histograms are kept, so the memory usage does not grow
+        with the number of users.
+
+        Args:
+            top (int, optional): number of heaviest users to keep. Defaults to 10.
+            from_ts (int, optional): equivalent to "from_ts". Defaults to None.
+            until_ts (int, optional): equivalent to "until_ts". Defaults to None.
+            limit (int, optional): number of users fetched per page. Defaults to 500.
+
+        Returns:
+            UsageReport: totals, the top users as (value, user id) pairs in descending order and histograms
+                mapping a power-of-two upper bound to the number of users below it
+        """
+        if top < 1:
+            raise ValueError("Argument 'top' must be a positive integer")
+        users = media_count = media_length = 0
+        top_length, top_count = [], []
+        length_histogram, count_histogram = {}, {}
+        for user in self._paginate(
+            self.statistics,
+            limit=limit,
+            from_ts=from_ts,
+            until_ts=until_ts
+        ):
+            users += 1
+            media_count += user["media_count"]
+            media_length += user["media_length"]
+            for heap, key in (
+                (top_length, "media_length"),
+                (top_count, "media_count")
+            ):
+                item = (user[key], user["user_id"])
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            for histogram, value in (
+                (length_histogram, user["media_length"]),
+                (count_histogram, user["media_count"])
+            ):
+                bucket = 1 << (value - 1).bit_length() if value > 0 else 0
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        return Media.UsageReport(
+            from_ts,
+            until_ts,
+            users,
+            media_count,
+            media_length,
+            sorted(top_length, reverse=True),
+            sorted(top_count, reverse=True),
+            dict(sorted(length_histogram.items())),
+            dict(sorted(count_histogram.items()))
+        )
+
+    def usage_report_windows(
+        self,
+        from_ts: int,
+        until_ts: int,
+        interval: int,
+        top: int = 10,
+        limit: int = 500
+    ) -> list:
+        """Summarize the media usage of all users in consecutive time windows
+
+        Args:
+            from_ts (int): start of the first window in millisecond
+            until_ts (int): end of the last window in millisecond
+            interval (int): length of each window in millisecond
+            top (int, optional): number of heaviest users to keep. Defaults to 10.
+            limit (int, optional): number of users fetched per page. Defaults to 500.
+
+        Returns:
+            list: a UsageReport for each window in chronological order
+        """
+        if interval <= 0:
+            raise ValueError("Argument 'interval' must be a positive integer")
+        reports = []
+        start = from_ts
+        while start < until_ts:
+            end = min(start + interval, until_ts)
+            reports.append(self.usage_report(top, start, end, limit))
+            start = end
+        return reports
+
     def list_media(self, roomid: str) -> ListOfMedia:
         """List all media in a specific room
 
@@ -294,6 +445,105 @@ class Media(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def _split_media_uri(self, uri: str) -> Tuple[str, str]:
+        """Split a mxc media URI into the origin server and the media id
+
+        Args:
+            uri (str): a mxc URI or a media id of the local server
+
+        Returns:
+            Tuple[str, str]: server name, media id
+        """
+        server_name = self.server_addr
+        if uri[:6] == "mxc://":
+            server_name = uri[6:].split("/")[0]
+        return server_name, self.extract_media_id(uri)
+
+    def _batch_media(
+        self,
+        method,
+        media: Iterable[str],
+        workers: int,
+        with_server: bool
+    ) -> list:
+        """Apply a single-media method to many media concurrently
+
+        Args:
+            method (Callable): one of the single-media methods
+            media (Iterable[str]): mxc URIs or media ids of the local server
+            workers (int): number of concurrent requests
+            with_server (bool): whether the method accepts a server_name
+
+        Returns:
+            list: list of Outcome, one per media
+        """
+        if isinstance(media, str):
+            raise TypeError("Argument 'media' must be an iterable of str")
+
+        def call(uri: str):
+            server_name, mediaid = self._split_media_uri(uri)
+            if with_server:
+                return method(mediaid, server_name)
+            return method(mediaid)
+
+        return list(Utility.concurrent_map(call, media, workers))
+
+    def quarantine_ids(
+        self,
+        media: Iterable[str],
+        workers: int = 8
+    ) -> list:
+        """Quarantine many media, possibly from different servers
+
+        Args:
+            media (Iterable[str]): mxc URIs or media ids of the local server
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+
+        Returns:
+            list: list of Outcome, item: the given URI, success: bool, result: returned value or exception # noqa: E501
+        """
+        return self._batch_media(self.quarantine_id, media, workers, True)
+
+    def quarantine_remove_ids(
+        self,
+        media: Iterable[str],
+        workers: int = 8
+    ) -> list:
+        """Remove many media from quarantine, possibly from different servers
+
+        Args:
+            media (Iterable[str]): mxc URIs or media ids of the local server
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+
+        Returns:
+            list: list of Outcome, item: the given URI, success: bool, result: returned value or exception # noqa: E501
+        """
+        return self._batch_media(self.quarantine_remove, media, workers, True)
+
+    def protect_ids(self, media: Iterable[str], workers: int = 8) -> list:
+        """Protect many media from being quarantined
+
+        Args:
+            media (Iterable[str]): mxc URIs or media ids
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+
+        Returns:
+            list: list of Outcome, item: the given URI, success: bool, result: returned value or exception # noqa: E501
+        """
+        return self._batch_media(self.protect_media, media, workers, False)
+
+    def unprotect_ids(self, media: Iterable[str], workers: int = 8) -> list:
+        """Remove quarantine protection for many media
+
+        Args:
+            media (Iterable[str]): mxc URIs or media ids
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+
+        Returns:
+            list: list of Outcome, item: the given URI, success: bool, result: returned value or exception # noqa: E501
+        """
+        return self._batch_media(self.unprotect_media, media, workers, False)
+
     def delete_media(
         self,
         mediaid: Union[str, list] = None,
@@ -437,7 +687,13 @@ class Media(Admin):
             json={},
         )
         data = resp.json()
-        return Contents(data["deleted_media"], data["total"])
+        if resp.status_code == 200:
+            return Contents(data["deleted_media"], data["total"])
+        else:
+            if self.suppress_exception:
+                return False, data
+            else:
+                raise SynapseException(data["errcode"], data["error"])
 
     def delete_media_by_user(
         self,
@@ -518,3 +774,502 @@ class Media(Admin):
                 return False, data
             else:
                 raise SynapseException(data["errcode"], data["error"])
+
+    def _delete_sliced(
+        self,
+        delete: Callable,
+        before_ts: int,
+        start_ts: int,
+        window: int,
+        target_duration: float,
+        checkpoint: str
+    ) -> SlicedDeletion:
+        """Run a deletion by timestamp in successive windows, oldest first
+
+        Args:
+            delete (Callable): takes a timestamp, returns the number and the ids of media deleted before it # noqa: E501
+            before_ts (int): the end of the last window in millisecond
+            start_ts (int): the start of the first window in millisecond
+            window (int): size of the first window in millisecond
+            target_duration (float): seconds a window should take
+            checkpoint (str): path to the checkpoint file, or None
+
+        Returns:
+            SlicedDeletion: deleted: number of media deleted, media: ids of media deleted by this call if known,
+                position: timestamp up to which media are deleted,
+                complete: whether everything before before_ts was deleted, error: the error if any
+        """
+        deleted, media, log = 0, [], None
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            with open(checkpoint, "r", encoding="utf8") as f:
+                progress = json.load(f)
+            start_ts, window = progress["position"], progress["window"]
+            deleted = progress["deleted"]
+        elif start_ts is None:
+            # Nothing can be older than the first user of the homeserver
+            oldest = self.user.lists(
+                limit=1,
+                deactivated=True,
+                order_by="creation_ts"
+            )
+            start_ts = before_ts
+            if Utility.is_success(oldest) and len(oldest) > 0:
+                start_ts = min(oldest[0]["creation_ts"], before_ts)
+
+        slicer = TimeSlicer(start_ts, before_ts, window, target_duration)
+        try:
+            if checkpoint is not None:
+                # Only the cursor is rewritten, ids are appended to a log
+                log = open(f"{checkpoint}.media", "a", encoding="utf8")
+            for _, until in slicer:
+                started = time.monotonic()
+                try:
+                    result = delete(until)
+                except SynapseException as e:
+                    return Media.SlicedDeletion(
+                        deleted, media, slicer.position, False, e
+                    )
+                if not Utility.is_success(result):
+                    return Media.SlicedDeletion(
+                        deleted, media, slicer.position, False, result
+                    )
+                deleted += result[0]
+                media.extend(result[1])
+                slicer.record(time.monotonic() - started)
+                if checkpoint is not None:
+                    if result[1]:
+                        log.writelines(
+                            f"{mediaid}\n" for mediaid in result[1]
+                        )
+                        log.flush()
+                    with open(f"{checkpoint}.tmp", "w", encoding="utf8") as f:
+                        json.dump(
+                            {
+                                "position": until,
+                                "window": slicer.window,
+                                "deleted": deleted
+                            },
+                            f,
+                            separators=(",", ":")
+                        )
+                    os.replace(f"{checkpoint}.tmp", checkpoint)
+        finally:
+            if log is not None:
+                log.close()
+        return Media.SlicedDeletion(
+            deleted, media, slicer.position, True, None
+        )
+
+    def purge_remote_media_sliced(
+        self,
+        before_ts: int,
+        start_ts: int = None,
+        window: int = 86400000,
+        target_duration: float = 30.0,
+        checkpoint: str = None
+    ) -> SlicedDeletion:
+        """Purge remote media cache in successive time windows, oldest first
+
+        Each window is sized from the duration of the previous one, so that
+        every purge takes about target_duration. With a checkpoint file, the
+        progress is saved after every window and a later call with the same
+        file resumes from the last completed window.
+
+        Args:
+            before_ts (int): purge media cached before this timestamp in millisecond # noqa: E501
+            start_ts (int, optional): the start of the first window in millisecond. Defaults to None (the creation of the first user). # noqa: E501
+            window (int, optional): size of the first window in millisecond. Defaults to 86400000 (a day). # noqa: E501
+            target_duration (float, optional): seconds a purge should take. Defaults to 30.0. # noqa: E501
+            checkpoint (str, optional): path to the checkpoint file. Defaults to None.
+
+        Returns:
+            SlicedDeletion: deleted: number of media purged, media: always empty,
+                position: timestamp up to which media are purged,
+                complete: whether everything before before_ts was purged, error: the error if any
+        """
+        def delete(until: int) -> Tuple[int, list]:
+            deleted = self.purge_remote_media(until)
+            if not Utility.is_success(deleted):
+                return deleted
+            return deleted, []
+
+        return self._delete_sliced(
+            delete,
+            before_ts,
+            start_ts,
+            window,
+            target_duration,
+            checkpoint
+        )
+
+    def delete_local_media_sliced(
+        self,
+        before_ts: int,
+        size_gt: int = 0,
+        keep_profiles: bool = True,
+        start_ts: int = None,
+        window: int = 86400000,
+        target_duration: float = 30.0,
+        checkpoint: str = None
+    ) -> SlicedDeletion:
+        """Delete local media with condition in successive time windows, oldest first
+
+        Each window is sized from the duration of the previous one, so that
+        every deletion takes about target_duration. With a checkpoint file, the
+        progress is saved after every window and a later call with the same
+        file resumes from the last completed window. The ids of deleted media
+        are appended to the checkpoint path plus ".media", one per line.
+
+        Args:
+            before_ts (int): delete media sent before this timestamp in millisecond # noqa: E501
+            size_gt (int, optional): delete media in which their size are greater than this size in bytes. Defaults to 0. # noqa: E501
+            keep_profiles (bool, optional): whether to keep profiles media or not. Defaults to True. # noqa: E501
+            start_ts (int, optional): the start of the first window in millisecond. Defaults to None (the creation of the first user). # noqa: E501
+            window (int, optional): size of the first window in millisecond. Defaults to 86400000 (a day). # noqa: E501
+            target_duration (float, optional): seconds a deletion should take. Defaults to 30.0. # noqa: E501
+            checkpoint (str, optional): path to the checkpoint file. Defaults to None.
+
+        Returns:
+            SlicedDeletion: deleted: number of media deleted, media: ids of media deleted by this call,
+                position: timestamp up to which media are deleted,
+                complete: whether everything before before_ts was deleted, error: the error if any
+        """
+        def delete(until: int) -> Tuple[int, list]:
+            deleted = self.delete_local_media_by_condition(
+                until,
+                size_gt,
+                keep_profiles
+            )
+            if not Utility.is_success(deleted):
+                return deleted
+            return deleted.total, list(deleted)
+
+        return self._delete_sliced(
+            delete,
+            before_ts,
+            start_ts,
+            window,
+            target_duration,
+            checkpoint
+        )
+
+    def retention_plan(
+        self,
+        before_ts: int,
+        size_gt: int = 0,
+        exclude_users: list = None,
+        keep_profiles: bool = True,
+        limit: int = 500,
+        workers: int = 4
+    ) -> RetentionPlan:
+        """Find local media that a retention policy would delete (dry run)
+
+        Only users having media uploaded before before_ts are visited. The media
+        of each user are paged by creation time and the paging stops at the
+        first media newer than before_ts. Protected media are never selected,
+        nor the avatars of users and rooms unless keep_profiles is False, which
+        costs one room details request per room.
+
+        Args:
+            before_ts (int): select media uploaded before this timestamp in millisecond # noqa: E501
+            size_gt (int, optional): select media larger than this size in bytes. Defaults to 0. # noqa: E501
+            exclude_users (list, optional): users whose media are kept. Defaults to None.
+            keep_profiles (bool, optional): whether to keep user and room avatars or not. Defaults to True. # noqa: E501
+            limit (int, optional): number of items fetched per page. Defaults to 500.
+            workers (int, optional): number of users queried concurrently. Defaults to 4. # noqa: E501
+
+        Returns:
+            RetentionPlan: the criteria, media: a dict with user id as key and a list of (media id, size) as value,
+                count: number of media selected, length: total size in bytes
+        """
+        if not isinstance(before_ts, int):
+            raise TypeError("Argument 'before_ts' must be an integer")
+        if size_gt < 0:
+            raise ValueError("Argument 'size_gt' must be a positive integer")
+        excluded = set()
+        if exclude_users is not None:
+            excluded = {self.validate_username(user) for user in exclude_users}
+        profiles = set()
+        if keep_profiles:
+            avatars = [
+                user.get("avatar_url") for user in self._paginate(
+                    self.user.lists,
+                    from_arg="offset",
+                    limit=limit,
+                    guests=True,
+                    deactivated=True
+                )
+            ]
+            # Room avatars are only returned by the details of a room
+            rooms = (
+                room["room_id"]
+                for room in self._paginate(self.room.lists, limit=limit)
+            )
+            for outcome in Utility.concurrent_map(
+                self.room.details,
+                rooms,
+                workers
+            ):
+                if not outcome.success:
+                    # An unknown avatar could be selected, stop here
+                    if isinstance(outcome.result, Exception):
+                        raise outcome.result
+                    raise SynapseException(
+                        outcome.result[1].get("errcode"),
+                        outcome.result[1].get("error")
+                    )
+                avatars.append(outcome.result.get("avatar"))
+            for uri in avatars:
+                if uri:
+                    server_name, mediaid = self._split_media_uri(uri)
+                    if server_name == self.server_addr:
+                        profiles.add(mediaid)
+
+        def collect(userid: str) -> list:
+            selected = []
+            for medium in self._paginate(
+                self.user.list_media,
+                userid=userid,
+                limit=limit,
+                order_by="created_ts",
+                _dir="f"
+            ):
+                if medium["created_ts"] >= before_ts:
+                    break
+                if (medium["media_length"] > size_gt
+                        and not medium["safe_from_quarantine"]
+                        and medium["media_id"] not in profiles):
+                    selected.append(
+                        (medium["media_id"], medium["media_length"])
+                    )
+            return selected
+
+        users = (
+            user["user_id"] for user in self._paginate(
+                self.statistics,
+                limit=limit,
+                until_ts=before_ts
+            ) if user["user_id"] not in excluded
+        )
+        media, count, length = {}, 0, 0
+        for outcome in Utility.concurrent_map(collect, users, workers):
+            if not outcome.success:
+                if isinstance(outcome.result, Exception):
+                    raise outcome.result
+                continue
+            if outcome.result:
+                media[outcome.item] = outcome.result
+                count += len(outcome.result)
+                length += sum(size for _, size in outcome.result)
+        return Media.RetentionPlan(before_ts, size_gt, media, count, length)
+
+    def retention_execute(
+        self,
+        plan: RetentionPlan,
+        batch_size: int = 100,
+        workers: int = 4,
+        pause: float = 0
+    ) -> RetentionReport:
+        """Delete the media selected by Media.retention_plan
+
+        Args:
+            plan (RetentionPlan): the plan returned by Media.retention_plan
+            batch_size (int, optional): number of media deleted before pausing. Defaults to 100. # noqa: E501
+            workers (int, optional): number of concurrent deletions. Defaults to 4.
+            pause (float, optional): seconds to sleep between batches. Defaults to 0.
+
+        Returns:
+            RetentionReport: deleted: list of deleted media id, failed: list of Outcome,
+                length: total size of deleted media in bytes
+        """
+        if batch_size < 1:
+            raise ValueError("Argument 'batch_size' must be a positive integer")
+        sizes = {}
+        for media in plan.media.values():
+            sizes.update(media)
+        mediaids = list(sizes)
+        deleted, failed, length = [], [], 0
+        for start in range(0, len(mediaids), batch_size):
+            if start > 0 and pause > 0:
+                time.sleep(pause)
+            for outcome in Utility.concurrent_map(
+                self.delete_local_media,
+                mediaids[start:start + batch_size],
+                workers
+            ):
+                if outcome.success:
+                    deleted.append(outcome.item)
+                    length += sizes[outcome.item]
+                else:
+                    failed.append(outcome)
+        return Media.RetentionReport(deleted, failed, length)
+
+    def media_inventory(
+        self,
+        inventory: Union["MediaInventory", str] = None,
+        rooms: Iterable[str] = None,
+        full: bool = False,
+        workers: int = 8,
+        limit: int = 500
+    ) -> "MediaInventory":
+        """Build or refresh an index of the media referenced in every room
+
+        Without full, only these rooms are crawled: rooms that are not in the
+        inventory yet, rooms given in the argument rooms and rooms joined by
+        local users who uploaded media since the last refresh. Remote media
+        posted into an indexed room by remote users are only picked up by a
+        full refresh. Rooms that no longer exist are dropped.
+
+        Args:
+            inventory (Union[MediaInventory, str], optional): an inventory or a path to load and save it. Defaults to None (new inventory). # noqa: E501
+            rooms (Iterable[str], optional): rooms to be crawled again. Defaults to None.
+            full (bool, optional): crawl all rooms again. Defaults to False.
+            workers (int, optional): number of rooms queried concurrently. Defaults to 8.
+            limit (int, optional): number of items fetched per page. Defaults to 500.
+
+        Returns:
+            MediaInventory: the updated inventory, saved to its path if it has one
+        """
+        if not isinstance(inventory, MediaInventory):
+            inventory = MediaInventory(inventory)
+        started = Utility.get_current_time()
+        existing = {
+            room["room_id"]
+            for room in self._paginate(self.room.lists, limit=limit)
+        }
+        for roomid in inventory.rooms():
+            if roomid not in existing:
+                inventory.remove(roomid)
+
+        if full or inventory.updated_ts is None:
+            targets = existing
+        else:
+            targets = existing - set(inventory.rooms())
+            if rooms is not None:
+                targets.update(self.validate_room(room) for room in rooms)
+            uploaders = (
+                user["user_id"] for user in self._paginate(
+                    self.statistics,
+                    limit=limit,
+                    from_ts=inventory.updated_ts
+                )
+            )
+            for outcome in Utility.concurrent_map(
+                self.user.joined_room,
+                uploaders,
+                workers
+            ):
+                if outcome.success:
+                    targets.update(existing.intersection(outcome.result))
+
+        for outcome in Utility.concurrent_map(
+            self.list_media,
+            targets,
+            workers
+        ):
+            if outcome.success:
+                inventory.update(outcome.item, *outcome.result)
+        inventory.updated_ts = started
+        if inventory.path is not None:
+            inventory.save()
+        return inventory
+
+
+class MediaInventory(BipartiteIndex):
+    """Inverted index between rooms and the media URIs referenced in them
+
+    Rooms are the keys and media URIs the values of the index, the number of
+    local media is kept for every room.
+    """
+
+    def _reset(self) -> None:
+        super()._reset()
+        self.updated_ts = None
+        self._room_local = {}
+
+    def __len__(self) -> int:
+        return len(self._value_keys)
+
+    def __contains__(self, uri: str) -> bool:
+        return self._value_ids.get(uri) in self._value_keys
+
+    def update(self, roomid: str, local: list, remote: list) -> None:
+        """Replace the media of a room
+
+        Args:
+            roomid (str): the room
+            local (list): mxc URIs of local media in the room
+            remote (list): mxc URIs of remote media in the room
+        """
+        self.remove(roomid)
+        room = self._link(roomid, (*local, *remote))
+        self._room_local[room] = len(local)
+
+    def remove(self, roomid: str) -> None:
+        """Remove a room from the inventory
+
+        Args:
+            roomid (str): the room
+        """
+        room = self._unlink(roomid)
+        if room is not None:
+            del self._room_local[room]
+
+    def rooms(self) -> list:
+        """List all indexed rooms
+
+        Returns:
+            list: room ids
+        """
+        return self._linked_keys()
+
+    def rooms_with(self, uri: str) -> list:
+        """List the rooms referencing a media
+
+        Args:
+            uri (str): the mxc URI of the media
+
+        Returns:
+            list: room ids
+        """
+        return self._keys_of(uri)
+
+    def media_in(self, roomid: str) -> list:
+        """List the media referenced in a room
+
+        Args:
+            roomid (str): the room
+
+        Returns:
+            list: mxc URIs, local media first
+        """
+        return self._values_of(roomid)
+
+    def counts(self) -> dict:
+        """Count the media of every room
+
+        Returns:
+            dict: a dict with room id as key and (local, remote) as value
+        """
+        return {
+            self._keys[room]: (
+                self._room_local[room],
+                len(uris) - self._room_local[room]
+            )
+            for room, uris in self._key_values.items()
+        }
+
+    def _dump(self) -> dict:
+        uris, links = self._dump_links()
+        rooms = {
+            roomid: [self._room_local[self._key_ids[roomid]], media]
+            for roomid, media in links.items()
+        }
+        return {"updated_ts": self.updated_ts, "uris": uris, "rooms": rooms}
+
+    def _restore(self, data: dict) -> None:
+        self.updated_ts = data["updated_ts"]
+        uris = data["uris"]
+        for roomid, (local, media) in data["rooms"].items():
+            media = [uris[i] for i in media]
+            self.update(roomid, media[:local], media[local:])
@@ -0,0 +1,267 @@
+"""MIT License
+
+Copyright (c) 2021 Knugi
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE."""
+
+import sqlite3
+from synapse_admin.base import Utility
+from synapse_admin.room import Room
+from typing import NamedTuple
+
+
+class Mirror():
+    """Local SQLite mirror of users, rooms and room memberships
+
+    The mirror is meant for questions that need joins across users and rooms,
+    for example Mirror.query("SELECT user_id FROM memberships GROUP BY user_id
+    HAVING COUNT(*) > 200").
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            displayname TEXT,
+            user_type TEXT,
+            admin INTEGER,
+            is_guest INTEGER,
+            deactivated INTEGER,
+            shadow_banned INTEGER,
+            creation_ts INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS users_creation_ts ON users (creation_ts);
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_id TEXT PRIMARY KEY,
+            name TEXT,
+            canonical_alias TEXT,
+            creator TEXT,
+            joined_members INTEGER,
+            joined_local_members INTEGER,
+            version TEXT,
+            encryption TEXT,
+            federatable INTEGER,
+            public INTEGER,
+            join_rules TEXT,
+            state_events INTEGER,
+            room_type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS rooms_creator ON rooms (creator);
+        CREATE INDEX IF NOT EXISTS rooms_joined_local_members
+            ON rooms (joined_local_members);
+        CREATE TABLE IF NOT EXISTS memberships (
+            room_id TEXT,
+            user_id TEXT,
+            PRIMARY KEY (room_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS memberships_user_id
+            ON memberships (user_id);
+    """
+    USER_COLUMNS = (
+        "name", "displayname", "user_type", "admin", "is_guest",
+        "deactivated", "shadow_banned", "creation_ts"
+    )
+    ROOM_COLUMNS = (
+        "room_id", "name", "canonical_alias", "creator", "joined_members",
+        "joined_local_members", "version", "encryption", "federatable",
+        "public", "join_rules", "state_events", "room_type"
+    )
+
+    class SyncReport(NamedTuple):
+        users: int
+        rooms: int
+        refreshed_rooms: int
+        removed_rooms: int
+        failed_rooms: list
+
+    def __init__(self, database: str, room: Room = None):
+        """
+        Args:
+            database (str): path to the SQLite database, ":memory:" is accepted
+            room (Room, optional): the handler used to query the homeserver. Defaults to None (read from the configuration file). # noqa: E501
+        """
+        if room is None:
+            room = Room()
+        self.room = room
+        self.user = room.user
+        self.db = sqlite3.connect(database)
+        self.db.executescript(Mirror.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """Close the database"""
+        self.db.close()
+
+    def query(self, sql: str, parameters: tuple = ()) -> list:
+        """Run a SQL query against the mirror
+
+        Args:
+            sql (str): the query
+            parameters (tuple, optional): parameters of the query. Defaults to ().
+
+        Returns:
+            list: rows returned by the query
+        """
+        return self.db.execute(sql, parameters).fetchall()
+
+    def sync(
+        self,
+        full: bool = False,
+        workers: int = 8,
+        limit: int = 500
+    ) -> SyncReport:
+        """Synchronize the mirror with the homeserver
+
+        Users are listed from the newest by creation_ts and the listing stops
+        at the newest user already mirrored. All rooms are listed (ordered by
+        joined_members), and only the members of new rooms and rooms whose
+        member counts changed are fetched again. Use full to re-crawl
+        everything, e.g. to pick up deactivations or membership swaps that keep
+        the counts unchanged.
+
+        Args:
+            full (bool, optional): re-crawl all users and room members. Defaults to False. # noqa: E501
+            workers (int, optional): number of rooms whose members are fetched concurrently. Defaults to 8. # noqa: E501
+            limit (int, optional): number of items fetched per page. Defaults to 500.
+
+        Returns:
+            SyncReport: number of users and rooms written, rooms whose members were fetched,
+                rooms removed and a list of Outcome for rooms failed to be fetched
+        """
+        users = self._sync_users(full, limit)
+        return self._sync_rooms(full, workers, limit)._replace(users=users)
+
+    def _sync_users(self, full: bool, limit: int) -> int:
+        newest = self.db.execute("SELECT MAX(creation_ts) FROM users")
+        newest = newest.fetchone()[0]
+        rows = []
+        for user in self.room._paginate(
+            self.user.lists,
+            from_arg="offset",
+            limit=limit,
+            guests=True,
+            deactivated=True,
+            order_by="creation_ts",
+            _dir="b"
+        ):
+            if (not full and newest is not None
+                    and user.get("creation_ts", 0) < newest):
+                break
+            rows.append(tuple(user.get(key) for key in Mirror.USER_COLUMNS))
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO users ({','.join(Mirror.USER_COLUMNS)}) "  # noqa: E501
+                f"VALUES ({','.join('?' * len(Mirror.USER_COLUMNS))})",
+                rows
+            )
+        return len(rows)
+
+    def _sync_rooms(self, full: bool, workers: int, limit: int) -> SyncReport:
+        known = dict(self.db.execute(
+            "SELECT room_id, joined_members FROM rooms"
+        ))
+        rows, changed = [], []
+        for room in self.room._paginate(
+            self.room.lists,
+            limit=limit,
+            orderby="joined_members"
+        ):
+            rows.append(tuple(room.get(key) for key in Mirror.ROOM_COLUMNS))
+            previous = known.pop(room["room_id"], None)
+            if full or previous != room["joined_members"]:
+                changed.append(room["room_id"])
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO rooms ({','.join(Mirror.ROOM_COLUMNS)}) "  # noqa: E501
+                f"VALUES ({','.join('?' * len(Mirror.ROOM_COLUMNS))})",
+                rows
+            )
+            for table in ("rooms", "memberships"):
+                self.db.executemany(
+                    f"DELETE FROM {table} WHERE room_id = ?",
+                    ((roomid,) for roomid in known)
+                )
+
+        failed = []
+        for outcome in Utility.concurrent_map(
+            self.room.list_members,
+            changed,
+            workers
+        ):
+            if not outcome.success:
+                failed.append(outcome)
+                continue
+            with self.db:
+                self.db.execute(
+                    "DELETE FROM memberships WHERE room_id = ?",
+                    (outcome.item,)
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO memberships VALUES (?, ?)",
+                    ((outcome.item, userid) for userid in outcome.result)
+                )
+        return Mirror.SyncReport(
+            0,
+            len(rows),
+            len(changed) - len(failed),
+            len(known),
+            failed
+        )
+
+    def rooms_without_local_members(self) -> list:
+        """List rooms with no local member
+
+        Returns:
+            list: room ids
+        """
+        rows = self.query(
+            "SELECT room_id FROM rooms WHERE joined_local_members = 0"
+        )
+        return [row[0] for row in rows]
+
+    def users_in_many_rooms(self, minimum: int) -> dict:
+        """List users joined to more than a number of rooms
+
+        Args:
+            minimum (int): the number of rooms
+
+        Returns:
+            dict: a dict with user id as key and the number of rooms as value
+        """
+        return dict(self.query(
+            "SELECT user_id, COUNT(*) AS joined FROM memberships "
+            "GROUP BY user_id HAVING joined > ? ORDER BY joined DESC",
+            (minimum,)
+        ))
+
+    def rooms_created_by_deactivated(self) -> list:
+        """List rooms created by deactivated users
+
+        Returns:
+            list: room ids
+        """
+        rows = self.query(
+            "SELECT rooms.room_id FROM rooms JOIN users "
+            "ON rooms.creator = users.name WHERE users.deactivated = 1"
+        )
+        return [row[0] for row in rows]
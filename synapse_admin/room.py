@@ -20,10 +20,21 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE."""
 
-from synapse_admin.base import Admin, SynapseException, Contents
+import gzip
+import heapq
+import threading
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+)
+from synapse_admin.base import (
+    Admin, SynapseException, Contents, Outcome, PersistentIndex, Utility
+)
 from synapse_admin import User
 from synapse_admin.client import ClientAPI
-from typing import NamedTuple
+from typing import Iterable, Mapping, NamedTuple, Tuple, Union
 
 
 class Room(Admin):
@@ -43,10 +54,53 @@ class Room(Admin):
         "join_rules", "guest_access", "history_visibility", "state_events"
     }
 
-    class RoomInformation(NamedTuple):
+    class _RoomInformation(NamedTuple):
         roomid: str
         joined: list
 
+    class RoomInformation(_RoomInformation):
+        """roomid and joined, failed is an attribute so that the tuple still
+        unpacks into (roomid, joined)"""
+
+        def __new__(cls, roomid: str, joined: list, failed: list = None):
+            information = super().__new__(cls, roomid, joined)
+            information.failed = [] if failed is None else failed
+            return information
+
+        @classmethod
+        def _make(cls, iterable: Iterable) -> "Room.RoomInformation":
+            return cls(*iterable)
+
+        def _replace(self, **kwargs) -> "Room.RoomInformation":
+            failed = kwargs.pop("failed", self.failed)
+            roomid, joined = super()._replace(**kwargs)
+            return Room.RoomInformation(roomid, joined, failed)
+
+        def __repr__(self) -> str:
+            return (
+                f"RoomInformation(roomid={self.roomid!r}, "
+                f"joined={self.joined!r}, failed={self.failed!r})"
+            )
+
+    class StateDiff(NamedTuple):
+        added: list
+        removed: list
+        changed: list
+
+    class ExtremitiesReport(NamedTuple):
+        before: list
+        deleted: dict
+        after: dict
+        failed: list
+
+    class ReapReport(NamedTuple):
+        candidates: list
+        deleted: list
+        failed: dict
+        pending: list
+        elapsed: float
+        rate: float
+
     def __init__(
         self,
         server_addr: str = None,
@@ -80,6 +134,7 @@ class Room(Admin):
         else:
             self.user = User()
             self.client_api = ClientAPI()
+        self.deletions = _DeletionTracker(self)
         self._create_alias()
 
     def _create_alias(self) -> None:
@@ -130,7 +185,7 @@ class Room(Admin):
                     "Argument 'orderby' must be included in Room.order, "
                     "for details please read documentation."
                 )
-            optional_str += f"&orderby={orderby}"
+            optional_str += f"&order_by={orderby}"
 
         if search:
             optional_str += f"&search_term={search}"
@@ -212,7 +267,8 @@ class Room(Admin):
         federation: bool = True,
         leave: bool = False,
         encrypted: bool = True,
-        room_type: str = None
+        room_type: str = None,
+        workers: int = 8
     ) -> RoomInformation:
         """Create a room and force users to be a member
 
@@ -224,9 +280,10 @@ class Room(Admin):
             federation (bool, optional): can the room be federated. Defaults to True.
             leave (bool, optional): whether to leave the room yourself after the creation. Defaults to False.
             room_type (str, optional): the type of room. Defaults to None.
+            workers (int, optional): number of members joined concurrently. Defaults to 8.
 
         Returns:
-            RoomInformation: roomid: room id, joined: a list of joined users
+            RoomInformation: roomid: room id, joined: a list of joined users, the attribute failed: a list of Outcome for users failed to join # noqa: E501
         """
         if members is None and leave:
             raise ValueError(
@@ -243,16 +300,185 @@ class Room(Admin):
             encrypted=encrypted,
             room_type=room_type
         )
-        joined = []
+        joined, failed = [], []
         if members is not None:
-            for member in members:
-                userid = self.validate_username(member)
-                if self.user.join_room(userid, roomid):
-                    joined.append(userid)
+            joined, failed = self._join_members(roomid, members, workers)
         if leave:
             self.client_api.client_leave(roomid)
 
-        return Room.RoomInformation(roomid, joined)
+        return Room.RoomInformation(roomid, joined, failed)
+
+    def _join_members(
+        self,
+        roomid: str,
+        members: list,
+        workers: int = 8
+    ) -> Tuple[list, list]:
+        """Force users to join a room concurrently
+
+        Args:
+            roomid (str): the room
+            members (list): the users
+            workers (int, optional): number of concurrent joins. Defaults to 8.
+
+        Returns:
+            Tuple[list, list]: joined users in the given order, a list of Outcome for users failed to join # noqa: E501
+        """
+        members = [self.validate_username(member) for member in members]
+        succeeded, failed = set(), []
+        for outcome in Utility.concurrent_map(
+            lambda userid: self.user.join_room(userid, roomid),
+            members,
+            workers
+        ):
+            if outcome.success:
+                succeeded.add(outcome.item)
+            else:
+                failed.append(outcome)
+        return [user for user in members if user in succeeded], failed
+
+    def provision(
+        self,
+        specs: Union[Mapping, Iterable[dict]],
+        workers: int = 8,
+        retries: int = 3
+    ) -> dict:
+        """Create many rooms and force their members to join
+
+        Creations, joins and leaves share one pool of workers. A rate limited
+        request is put back in the queue until the time asked by the homeserver
+        has passed, so no worker sleeps, and the members of a room start joining
+        as soon as the room is created.
+
+        Each spec is a dict accepting the keyword arguments of Room.create:
+        public, alias, name, members, federation, encrypted, room_type and leave.
+
+        Args:
+            specs (Union[Mapping, Iterable[dict]]): a dict of specs or an iterable of specs (keyed by position) # noqa: E501
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+            retries (int, optional): maximum number of retries for a rate limited request. Defaults to 3. # noqa: E501
+
+        Returns:
+            dict: a dict with the key of the spec as key and RoomInformation as value,
+                roomid is None and failed contains the error if the room cannot be created
+        """
+        if isinstance(specs, Mapping):
+            specs = list(specs.items())
+        else:
+            specs = list(enumerate(specs))
+        for _, spec in specs:
+            if not spec.get("members") and spec.get("leave"):
+                raise ValueError(
+                    "You cannot create a room and leave"
+                    " the room immediately since you"
+                    " are the only member of the room"
+                )
+
+        def create(spec: dict) -> str:
+            return self.client_api.client_create_room(
+                spec.get("public", False),
+                spec.get("alias"),
+                spec.get("name"),
+                federation=spec.get("federation", True),
+                encrypted=spec.get("encrypted", True),
+                room_type=spec.get("room_type"),
+                retry=False
+            )
+
+        def join(item: Tuple[str, str]) -> bool:
+            return self.user.join_room(*item)
+
+        spec_of = dict(specs)
+        queue = iter(specs)
+        results, members, remaining, pending = {}, {}, {}, {}
+        # Rate limited requests as (ready time, sequence, request, attempt)
+        delayed, sequence = [], 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def submit(task: str, key, func, item, attempt: int = 0) -> None:
+                future = executor.submit(func, item)
+                pending[future] = ((task, key, func, item), attempt)
+
+            def create_next() -> None:
+                for key, spec in queue:
+                    submit("create", key, create, spec)
+                    return
+
+            for _ in range(workers):
+                create_next()
+            while pending or delayed:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    _, _, request, attempt = heapq.heappop(delayed)
+                    submit(*request, attempt)
+                if not pending:
+                    time.sleep(delayed[0][0] - now)
+                    continue
+                timeout = delayed[0][0] - now if delayed else None
+                done, _ = wait(pending, timeout, FIRST_COMPLETED)
+                for future in done:
+                    request, attempt = pending.pop(future)
+                    task, key, _, item = request
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        outcome = Outcome(item, False, e)
+                    else:
+                        outcome = Outcome(
+                            item,
+                            Utility.is_success(result),
+                            result
+                        )
+                    if not outcome.success and attempt < retries:
+                        delay = Utility._retry_delay(outcome.result, attempt)
+                        if delay is not None:
+                            heapq.heappush(delayed, (
+                                time.monotonic() + delay,
+                                sequence,
+                                request,
+                                attempt + 1
+                            ))
+                            sequence += 1
+                            continue
+                    if task == "create":
+                        create_next()
+                        if not outcome.success:
+                            results[key] = Room.RoomInformation(
+                                None, [], [outcome._replace(item=key)]
+                            )
+                            continue
+                        roomid = outcome.result
+                        results[key] = Room.RoomInformation(roomid, [], [])
+                        members[key] = [
+                            self.validate_username(member)
+                            for member in item.get("members") or []
+                        ]
+                        remaining[key] = len(members[key])
+                        for userid in members[key]:
+                            submit("join", key, join, (userid, roomid))
+                    elif task == "join":
+                        if outcome.success:
+                            results[key].joined.append(item[0])
+                        else:
+                            results[key].failed.append(
+                                outcome._replace(item=item[0])
+                            )
+                        remaining[key] -= 1
+                        if remaining[key] == 0 and spec_of[key].get("leave"):
+                            submit(
+                                "leave",
+                                key,
+                                self.client_api.client_leave,
+                                results[key].roomid
+                            )
+                    elif not outcome.success:
+                        results[key].failed.append(outcome)
+
+        for key, info in results.items():
+            joined = set(info.joined)
+            info.joined[:] = [
+                user for user in members.get(key, ()) if user in joined
+            ]
+        return {key: results[key] for key, _ in specs}
 
     def delete(
         self,
@@ -465,6 +691,108 @@ class Room(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def forward_extremities_audit(
+        self,
+        threshold: int = None,
+        rooms: Iterable[str] = None,
+        workers: int = 8,
+        batch_size: int = 10,
+        pause: float = 1.0,
+        limit: int = 500
+    ) -> ExtremitiesReport:
+        """Audit forward extremities of rooms and optionally delete them
+
+        Args:
+            threshold (int, optional): delete the forward extremities of rooms having more than this number of extremities. Defaults to None (audit only). # noqa: E501
+            rooms (Iterable[str], optional): rooms to audit. Defaults to None (all rooms). # noqa: E501
+            workers (int, optional): number of rooms checked or remediated concurrently. Defaults to 8. # noqa: E501
+            batch_size (int, optional): number of rooms remediated before pausing. Defaults to 10. # noqa: E501
+            pause (float, optional): seconds to wait between remediation batches. Defaults to 1.0. # noqa: E501
+            limit (int, optional): number of rooms listed per page. Defaults to 500. # noqa: E501
+
+        Returns:
+            ExtremitiesReport: before: (room id, count) pairs ranked by count in descending order,
+                deleted: a dict with room id as key and number of extremities deleted as value,
+                after: a dict with room id as key and count after the remediation as value,
+                failed: a list of Outcome for rooms failed to be checked or remediated
+        """
+        if rooms is None:
+            rooms = (
+                room["room_id"]
+                for room in self._paginate(self.lists, limit=limit)
+            )
+        before, failed = [], []
+        for outcome in Utility.concurrent_map(
+            self.forward_extremities_check,
+            rooms,
+            workers
+        ):
+            if outcome.success:
+                before.append((outcome.item, outcome.result.total))
+            else:
+                failed.append(outcome)
+        before.sort(key=lambda item: item[1], reverse=True)
+
+        deleted, after = {}, {}
+        if threshold is None:
+            return Room.ExtremitiesReport(before, deleted, after, failed)
+        targets = [roomid for roomid, count in before if count > threshold]
+        for start in range(0, len(targets), batch_size):
+            if start and pause:
+                time.sleep(pause)
+            for outcome in Utility.concurrent_map(
+                self.forward_extremities_delete,
+                targets[start:start + batch_size],
+                workers
+            ):
+                if outcome.success:
+                    deleted[outcome.item] = outcome.result
+                else:
+                    failed.append(outcome)
+        for outcome in Utility.concurrent_map(
+            self.forward_extremities_check,
+            list(deleted),
+            workers
+        ):
+            if outcome.success:
+                after[outcome.item] = outcome.result.total
+            else:
+                failed.append(outcome)
+        return Room.ExtremitiesReport(before, deleted, after, failed)
+
+    def membership_graph(
+        self,
+        rooms: Iterable[str] = None,
+        workers: int = 8,
+        limit: int = 500
+    ) -> Tuple["MembershipGraph", list]:
+        """Crawl room members concurrently into a MembershipGraph
+
+        Args:
+            rooms (Iterable[str], optional): rooms to crawl. Defaults to None (all rooms). # noqa: E501
+            workers (int, optional): number of rooms crawled concurrently. Defaults to 8. # noqa: E501
+            limit (int, optional): number of rooms listed per page. Defaults to 500. # noqa: E501
+
+        Returns:
+            Tuple[MembershipGraph, list]: the graph and a list of Outcome for rooms failed to be crawled # noqa: E501
+        """
+        if rooms is None:
+            rooms = (
+                room["room_id"]
+                for room in self._paginate(self.lists, limit=limit)
+            )
+        graph, failed = MembershipGraph(), []
+        for outcome in Utility.concurrent_map(
+            self.list_members,
+            rooms,
+            workers
+        ):
+            if outcome.success:
+                graph.add_room(outcome.item, outcome.result)
+            else:
+                failed.append(outcome)
+        return graph, failed
+
     def get_state(self, roomid: str) -> list:
         """Query the room state
 
@@ -490,6 +818,47 @@ class Room(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def refresh_state(
+        self,
+        store: "RoomStateStore",
+        rooms: Iterable[str] = None,
+        workers: int = 8,
+        limit: int = 500
+    ) -> dict:
+        """Fetch the state of rooms into a snapshot store and diff against it
+
+        Args:
+            store (RoomStateStore): the store holding the previous snapshots
+            rooms (Iterable[str], optional): rooms to refresh. Defaults to None (all rooms). # noqa: E501
+            workers (int, optional): number of rooms fetched concurrently. Defaults to 8.
+            limit (int, optional): number of rooms listed per page. Defaults to 500. # noqa: E501
+
+        Returns:
+            dict: a dict with room id as key and StateDiff as value for rooms whose state changed,
+                added: new events, removed: events no longer in the state, changed: (old event, new event) pairs
+                When all rooms are refreshed, rooms that no longer exist are removed from the store.
+        """
+        diffs = {}
+        if rooms is None:
+            rooms = {
+                room["room_id"]
+                for room in self._paginate(self.lists, limit=limit)
+            }
+            for roomid in set(store.rooms) - rooms:
+                diffs[roomid] = store.update(roomid, [])
+                store.remove(roomid)
+        else:
+            rooms = [self.validate_room(room) for room in rooms]
+        for outcome in Utility.concurrent_map(self.get_state, rooms, workers):
+            if not outcome.success:
+                continue
+            diff = store.update(outcome.item, outcome.result)
+            if diff.added or diff.removed or diff.changed:
+                diffs[outcome.item] = diff
+        if store.path is not None:
+            store.save()
+        return diffs
+
     def event_context(self, roomid: str, event_id: str) -> dict:
         """Query the context of an event
 
@@ -568,6 +937,80 @@ class Room(Admin):
             else:
                 raise SynapseException(data["errcode"], data["error"])
 
+    def reap_empty_rooms(
+        self,
+        dry_run: bool = False,
+        keep: Iterable[str] = None,
+        workers: int = 8,
+        limit: int = 500,
+        timeout: float = None,
+        **kwargs
+    ) -> ReapReport:
+        """Delete all rooms without local members
+
+        Rooms are listed with the fewest local members first and the listing
+        stops at the first room having local members. The candidates are
+        collected before any deletion starts, so the deletions cannot shift
+        the pages being read.
+
+        Args:
+            dry_run (bool, optional): only list the candidates. Defaults to False.
+            keep (Iterable[str], optional): rooms never to be deleted. Defaults to None. # noqa: E501
+            workers (int, optional): number of concurrent deletion requests. Defaults to 8. # noqa: E501
+            limit (int, optional): number of rooms listed per page. Defaults to 500. # noqa: E501
+            timeout (float, optional): maximum seconds to wait for the deletions. Defaults to None (forever). # noqa: E501
+            **kwargs: other arguments passed to Room.delete_async
+
+        Returns:
+            ReapReport: candidates: rooms without local members,
+                deleted: rooms deleted, failed: a dict with room id as key and the error as value,
+                pending: rooms still being deleted when the timeout was hit,
+                elapsed: seconds spent on the deletions, rate: rooms deleted per second
+        """
+        keep = {self.validate_room(roomid) for roomid in keep or ()}
+        candidates = []
+        # joined_local_members is sorted in ascending order with dir=b
+        for room in self._paginate(
+            self.lists,
+            limit=limit,
+            orderby="joined_local_members",
+            recent_first=True
+        ):
+            if room["joined_local_members"] > 0:
+                break
+            if room["room_id"] not in keep:
+                candidates.append(room["room_id"])
+        if dry_run:
+            return Room.ReapReport(candidates, [], {}, [], 0.0, 0.0)
+
+        start = time.monotonic()
+        futures = self.deletions.submit_many(
+            candidates,
+            workers=workers,
+            **kwargs
+        )
+        wait(futures.values(), timeout)
+        elapsed = time.monotonic() - start
+        deleted, failed, pending = [], {}, []
+        for roomid, future in futures.items():
+            if not future.done():
+                pending.append(roomid)
+            elif future.exception() is not None:
+                failed[roomid] = future.exception()
+            elif (Utility.is_success(future.result())
+                    and future.result()["status"] == "complete"):
+                deleted.append(roomid)
+            else:
+                failed[roomid] = future.result()
+        return Room.ReapReport(
+            candidates,
+            deleted,
+            failed,
+            pending,
+            elapsed,
+            len(deleted) / elapsed if elapsed else 0.0
+        )
+
     def delete_status(
         self,
         *,
@@ -697,3 +1140,510 @@ class Room(Admin):
                 return False, data
             else:
                 raise SynapseException(data["errcode"], data["error"])
+
+
+class _DeletionTracker():
+    """Submit asynchronous room deletions and watch them in one polling loop
+
+    Every delete id is polled by a single background thread. The interval of a
+    deletion grows while it is purging and is shortened when the deletion is
+    about to reach the average duration of the deletions finished so far.
+    """
+
+    def __init__(
+        self,
+        room: Room,
+        min_interval: float = 0.5,
+        max_interval: float = 30.0
+    ):
+        self.room = room
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.average_duration = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def submit(self, roomid: str, callback=None, **kwargs) -> Future:
+        """Delete a room with Room.delete_async and track the deletion
+
+        Args:
+            roomid (str): the room you want to delete
+            callback (Callable, optional): called with the future when the deletion finishes. Defaults to None. # noqa: E501
+            **kwargs: other arguments passed to Room.delete_async
+
+        Returns:
+            Future: resolved with the final result of Room.delete_status_id, whose status is either "complete" or "failed" # noqa: E501
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        try:
+            deleteid = self.room.delete_async(roomid, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if not Utility.is_success(deleteid):
+            future.set_result(deleteid)
+            return future
+        return self.track(deleteid, future)
+
+    def submit_many(
+        self,
+        roomids: Iterable[str],
+        callback=None,
+        workers: int = 8,
+        **kwargs
+    ) -> dict:
+        """Delete many rooms and track all the deletions
+
+        Args:
+            roomids (Iterable[str]): the rooms you want to delete
+            callback (Callable, optional): called with the future when a deletion finishes. Defaults to None. # noqa: E501
+            workers (int, optional): number of concurrent deletion requests. Defaults to 8. # noqa: E501
+            **kwargs: other arguments passed to Room.delete_async
+
+        Returns:
+            dict: a dict with room id as key and Future as value
+        """
+        return {
+            outcome.item: outcome.result
+            for outcome in Utility.concurrent_map(
+                lambda roomid: self.submit(roomid, callback, **kwargs),
+                roomids,
+                workers
+            )
+        }
+
+    def track(self, deleteid: str, future: Future = None) -> Future:
+        """Track a deletion started elsewhere
+
+        Args:
+            deleteid (str): the delete id returned by Room.delete_async
+            future (Future, optional): the future to resolve. Defaults to None (a new one). # noqa: E501
+
+        Returns:
+            Future: resolved with the final result of Room.delete_status_id
+        """
+        if future is None:
+            future = Future()
+        now = time.monotonic()
+        with self._lock:
+            self._jobs[deleteid] = {
+                "future": future,
+                "started": now,
+                "interval": self.min_interval,
+                "next_poll": now + self.min_interval
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait until all tracked deletions finish
+
+        Args:
+            timeout (float, optional): maximum seconds to wait. Defaults to None (forever). # noqa: E501
+
+        Returns:
+            bool: whether all deletions finished
+        """
+        with self._lock:
+            futures = [job["future"] for job in self._jobs.values()]
+        _, not_done = wait(futures, timeout)
+        return len(not_done) == 0
+
+    def _next_interval(self, job: dict, status: str, now: float) -> float:
+        interval = job["interval"]
+        if status == "purging":
+            interval = min(interval * 1.5, self.max_interval)
+        if self.average_duration is not None:
+            remaining = self.average_duration - (now - job["started"])
+            if remaining > 0:
+                interval = max(self.min_interval, min(interval, remaining))
+        return interval
+
+    def _finish(self, deleteid: str, job: dict, now: float) -> None:
+        duration = now - job["started"]
+        if self.average_duration is None:
+            self.average_duration = duration
+        else:
+            self.average_duration = (
+                0.8 * self.average_duration + 0.2 * duration
+            )
+        with self._lock:
+            del self._jobs[deleteid]
+
+    def _run(self) -> None:
+        while True:
+            # Cleared before the jobs are read, so a job tracked from now on
+            # sets the event again and the wait below returns at once
+            self._wakeup.clear()
+            now = time.monotonic()
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+                due = [
+                    (deleteid, job) for deleteid, job in self._jobs.items()
+                    if job["next_poll"] <= now
+                ]
+            for deleteid, job in due:
+                try:
+                    status = self.room.delete_status_id(deleteid)
+                except Exception as e:
+                    self._finish(deleteid, job, time.monotonic())
+                    job["future"].set_exception(e)
+                    continue
+                now = time.monotonic()
+                if (not Utility.is_success(status)
+                        or status["status"] in ("complete", "failed")):
+                    self._finish(deleteid, job, now)
+                    job["future"].set_result(status)
+                    continue
+                job["interval"] = self._next_interval(
+                    job,
+                    status["status"],
+                    now
+                )
+                job["next_poll"] = now + job["interval"]
+            with self._lock:
+                if not self._jobs:
+                    continue
+                delay = min(
+                    job["next_poll"] for job in self._jobs.values()
+                ) - time.monotonic()
+            self._wakeup.wait(max(delay, 0))
+
+
+class RoomStateStore(PersistentIndex):
+    """Snapshots of room state keyed by (type, state_key)
+
+    Only the event id, sender and content of each state event are kept.
+    Snapshots are compared by event id, so an unchanged room costs one dict
+    lookup per state event.
+    """
+
+    def _reset(self) -> None:
+        self.rooms = {}
+
+    @staticmethod
+    def _open(path: str, mode: str):
+        return gzip.open(path, mode, encoding="utf8")
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    def __contains__(self, roomid: str) -> bool:
+        return roomid in self.rooms
+
+    @staticmethod
+    def _event(key: tuple, value: tuple) -> dict:
+        event_id, sender, content = value
+        return {
+            "type": key[0],
+            "state_key": key[1],
+            "event_id": event_id,
+            "sender": sender,
+            "content": content
+        }
+
+    def update(self, roomid: str, state: list) -> Room.StateDiff:
+        """Replace the snapshot of a room
+
+        Args:
+            roomid (str): the room
+            state (list): state events returned by Room.get_state
+
+        Returns:
+            StateDiff: the difference from the previous snapshot
+        """
+        new = {
+            (event["type"], event["state_key"]): (
+                event["event_id"],
+                event.get("sender"),
+                event.get("content", {})
+            )
+            for event in state
+        }
+        old = self.rooms.get(roomid, {})
+        added, changed = [], []
+        for key, value in new.items():
+            previous = old.get(key)
+            if previous is None:
+                added.append(self._event(key, value))
+            elif previous[0] != value[0]:
+                changed.append(
+                    (self._event(key, previous), self._event(key, value))
+                )
+        removed = [
+            self._event(key, value)
+            for key, value in old.items() if key not in new
+        ]
+        self.rooms[roomid] = new
+        return Room.StateDiff(added, removed, changed)
+
+    def remove(self, roomid: str) -> None:
+        """Remove the snapshot of a room
+
+        Args:
+            roomid (str): the room
+        """
+        self.rooms.pop(roomid, None)
+
+    def get(
+        self,
+        roomid: str,
+        event_type: str,
+        state_key: str = ""
+    ) -> dict:
+        """Get the content of a state event from the snapshot
+
+        Args:
+            roomid (str): the room
+            event_type (str): the type of the state event
+            state_key (str, optional): the state key. Defaults to "".
+
+        Returns:
+            dict: content of the state event, None if not found
+        """
+        value = self.rooms.get(roomid, {}).get((event_type, state_key))
+        if value is None:
+            return None
+        return value[2]
+
+    def find(
+        self,
+        event_type: str,
+        predicate,
+        state_key: str = ""
+    ) -> list:
+        """Find the rooms whose state event satisfies a condition
+
+        Args:
+            event_type (str): the type of the state event
+            predicate (Callable): called with the content, returns bool
+            state_key (str, optional): the state key. Defaults to "".
+
+        Returns:
+            list: room ids
+        """
+        key = (event_type, state_key)
+        return [
+            roomid for roomid, state in self.rooms.items()
+            if key in state and predicate(state[key][2])
+        ]
+
+    def power_levels(self, userid: str) -> dict:
+        """Get the power level of a user in every room
+
+        Args:
+            userid (str): the user
+
+        Returns:
+            dict: a dict with room id as key and the power level as value
+        """
+        levels = {}
+        for roomid, state in self.rooms.items():
+            value = state.get(("m.room.power_levels", ""))
+            if value is None:
+                continue
+            content = value[2]
+            levels[roomid] = content.get("users", {}).get(
+                userid,
+                content.get("users_default", 0)
+            )
+        return levels
+
+    def rooms_with_power_level(self, userid: str, level: int = 100) -> list:
+        """Find the rooms where a user has a specific power level
+
+        Args:
+            userid (str): the user
+            level (int, optional): the power level. Defaults to 100.
+
+        Returns:
+            list: room ids
+        """
+        return [
+            roomid for roomid, value in self.power_levels(userid).items()
+            if value == level
+        ]
+
+    def _dump(self) -> dict:
+        return {
+            roomid: [[*key, *value] for key, value in state.items()]
+            for roomid, state in self.rooms.items()
+        }
+
+    def _restore(self, data: dict) -> None:
+        self.rooms = {
+            roomid: {
+                (event_type, state_key): (event_id, sender, content)
+                for event_type, state_key, event_id, sender, content in state
+            }
+            for roomid, state in data.items()
+        }
+
+
+class MembershipGraph():
+    """User-room membership graph in compressed sparse row form
+
+    User and room ids are interned as integers. The members of each room are
+    stored back to back in one array with an offset array marking where each
+    room starts, and the same layout indexed by user is derived on demand for
+    the user side queries.
+    """
+
+    def __init__(self):
+        self._users, self._user_ids = [], {}
+        self._rooms, self._room_ids = [], {}
+        self._room_offsets = array("L", [0])
+        self._room_members = array("L")
+        self._user_offsets = None
+        self._user_rooms = None
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, userid: str) -> bool:
+        return userid in self._user_ids
+
+    @property
+    def rooms(self) -> list:
+        return self._rooms
+
+    @property
+    def users(self) -> list:
+        return self._users
+
+    def add_room(self, roomid: str, members: Iterable[str]) -> None:
+        """Add a room and its members to the graph
+
+        Args:
+            roomid (str): the room
+            members (Iterable[str]): user ids of the members
+
+        Raises:
+            ValueError: the room was added before
+        """
+        if roomid in self._room_ids:
+            raise ValueError(f"Room {roomid} is already in the graph")
+        self._room_ids[roomid] = len(self._rooms)
+        self._rooms.append(roomid)
+        for userid in members:
+            user = self._user_ids.get(userid)
+            if user is None:
+                user = self._user_ids[userid] = len(self._users)
+                self._users.append(userid)
+            self._room_members.append(user)
+        self._room_offsets.append(len(self._room_members))
+        self._user_offsets = self._user_rooms = None
+
+    def _index(self) -> None:
+        if self._user_offsets is not None:
+            return
+        offsets = array("L", [0]) * (len(self._users) + 1)
+        for user in self._room_members:
+            offsets[user + 1] += 1
+        for user in range(len(self._users)):
+            offsets[user + 1] += offsets[user]
+        cursor = offsets[:-1]
+        rooms = array("L", [0]) * len(self._room_members)
+        for room in range(len(self._rooms)):
+            start, end = self._room_offsets[room], self._room_offsets[room + 1]
+            for user in self._room_members[start:end]:
+                rooms[cursor[user]] = room
+                cursor[user] += 1
+        self._user_offsets, self._user_rooms = offsets, rooms
+
+    def _members(self, room: int) -> array:
+        start, end = self._room_offsets[room], self._room_offsets[room + 1]
+        return self._room_members[start:end]
+
+    def _rooms_of(self, userid: str) -> array:
+        user = self._user_ids.get(userid)
+        if user is None:
+            return array("L")
+        self._index()
+        start, end = self._user_offsets[user], self._user_offsets[user + 1]
+        return self._user_rooms[start:end]
+
+    def members(self, roomid: str) -> list:
+        """List the members of a room
+
+        Args:
+            roomid (str): the room
+
+        Returns:
+            list: user ids
+        """
+        room = self._room_ids.get(roomid)
+        if room is None:
+            return []
+        return [self._users[user] for user in self._members(room)]
+
+    def rooms_of(self, userid: str) -> list:
+        """List the rooms a user is in
+
+        Args:
+            userid (str): the user
+
+        Returns:
+            list: room ids
+        """
+        return [self._rooms[room] for room in self._rooms_of(userid)]
+
+    def degree(self, userid: str) -> int:
+        """Query the number of rooms a user is in
+
+        Args:
+            userid (str): the user
+
+        Returns:
+            int: number of rooms
+        """
+        return len(self._rooms_of(userid))
+
+    def shared_rooms(self, userid1: str, userid2: str) -> list:
+        """List the rooms two users are both in
+
+        Args:
+            userid1 (str): a user
+            userid2 (str): another user
+
+        Returns:
+            list: room ids
+        """
+        rooms = set(self._rooms_of(userid1))
+        return [
+            self._rooms[room]
+            for room in self._rooms_of(userid2) if room in rooms
+        ]
+
+    def neighbours(self, userid: str, max_members: int = None) -> Counter:
+        """Count the rooms a user shares with every other user
+
+        Args:
+            userid (str): the user
+            max_members (int, optional): ignore rooms with more members than this number, e.g. large public rooms. Defaults to None. # noqa: E501
+
+        Returns:
+            Counter: user ids as key and number of shared rooms as value
+        """
+        user = self._user_ids.get(userid)
+        counts = Counter()
+        for room in self._rooms_of(userid):
+            members = self._members(room)
+            if max_members is None or len(members) <= max_members:
+                counts.update(members)
+        counts.pop(user, None)
+        return Counter({
+            self._users[other]: count for other, count in counts.items()
+        })
@@ -22,8 +22,13 @@ SOFTWARE."""
 
 import hashlib
 import hmac
-from synapse_admin.base import Admin, SynapseException, Utility, Contents
-from typing import Union, Tuple
+import threading
+import time
+from concurrent.futures import Future
+from synapse_admin.base import (
+    Admin, SynapseException, PersistentIndex, Utility, Contents
+)
+from typing import Iterable, NamedTuple, Union, Tuple
 
 
 class User(Admin):
@@ -39,6 +44,12 @@ class User(Admin):
     ORDER = ("name", "is_guest", "admin", "user_type", "deactivated",
              "shadow_banned", "displayname", "avatar_url", "creation_ts")
 
+    class DevicePruneReport(NamedTuple):
+        users: int
+        selected: dict
+        deleted: int
+        failed: list
+
     def __init__(
         self,
         server_addr: str = None,
@@ -247,6 +258,154 @@ class User(Admin):
         data = resp.json()["devices"][""]
         return data["sessions"][0]["connections"]
 
+    def session_index(
+        self,
+        index: Union["SessionIndex", str] = None,
+        users: Iterable[str] = None,
+        max_age: int = 86400000,
+        workers: int = 8,
+        limit: int = 500
+    ) -> "SessionIndex":
+        """Collect the sessions of many users into an IP and user agent index
+
+        Without users, every active local user is listed and only these users
+        are queried: users not in the index, users seen (last_seen_ts) since
+        they were last queried and users last queried more than max_age ago.
+        Users that are no longer listed are dropped. Given users are always
+        queried.
+
+        Args:
+            index (Union[SessionIndex, str], optional): an index or a path to load and save it. Defaults to None (new index). # noqa: E501
+            users (Iterable[str], optional): users to query. Defaults to None (all users). # noqa: E501
+            max_age (int, optional): milliseconds after which a user is queried again. Defaults to 86400000 (a day). # noqa: E501
+            workers (int, optional): number of users queried concurrently. Defaults to 8. # noqa: E501
+            limit (int, optional): number of users listed per page. Defaults to 500.
+
+        Returns:
+            SessionIndex: the updated index, saved to its path if it has one
+        """
+        if not isinstance(index, SessionIndex):
+            index = SessionIndex(index)
+        now = Utility.get_current_time()
+        if users is not None:
+            targets = [self.validate_username(user) for user in users]
+        else:
+            targets, listed = [], set()
+            for user in self._paginate(
+                self.lists,
+                from_arg="offset",
+                limit=limit
+            ):
+                userid = user["name"]
+                listed.add(userid)
+                queried = index.queried_ts(userid)
+                if (queried is None
+                        or (user.get("last_seen_ts") or 0) > queried
+                        or now - queried > max_age):
+                    targets.append(userid)
+            for userid in set(index.users()) - listed:
+                index.remove(userid)
+
+        def query(userid: str) -> list:
+            try:
+                return self.active_sessions(userid)
+            except IndexError:
+                # The user has no session at all
+                return []
+
+        for outcome in Utility.concurrent_map(query, targets, workers):
+            if outcome.success and Utility.is_success(outcome.result):
+                index.update(outcome.item, outcome.result, now)
+        if index.path is not None:
+            index.save()
+        return index
+
+    def prune_devices(
+        self,
+        idle_days: float = 90,
+        users: Iterable[str] = None,
+        dry_run: bool = False,
+        chunk_size: int = 100,
+        workers: int = 8,
+        limit: int = 500,
+        now: int = None
+    ) -> DevicePruneReport:
+        """Delete the devices not seen for a number of days
+
+        The devices of every user are listed concurrently. Devices whose
+        last_seen_ts is older than idle_days are deleted with one
+        delete_devices request per chunk of devices, several users at a time.
+        Devices never seen (no last_seen_ts) are kept.
+
+        Args:
+            idle_days (float, optional): delete devices idle for longer than this number of days. Defaults to 90. # noqa: E501
+            users (Iterable[str], optional): users whose devices are pruned. Defaults to None (all users). # noqa: E501
+            dry_run (bool, optional): only select the devices. Defaults to False.
+            chunk_size (int, optional): maximum number of devices in one request. Defaults to 100. # noqa: E501
+            workers (int, optional): number of concurrent requests. Defaults to 8.
+            limit (int, optional): number of users listed per page. Defaults to 500.
+            now (int, optional): the current time in millisecond. Defaults to None (Utility.get_current_time()). # noqa: E501
+
+        Returns:
+            DevicePruneReport: users: number of users whose devices were listed,
+                selected: a dict with user id as key and a list of idle device ids as value,
+                deleted: number of devices deleted, failed: a list of Outcome for failed requests
+        """
+        if chunk_size < 1:
+            raise ValueError(
+                "Argument 'chunk_size' must be a positive integer"
+            )
+        if now is None:
+            now = Utility.get_current_time()
+        cutoff = now - int(idle_days * 86400000)
+        if users is None:
+            users = (
+                user["name"] for user in self._paginate(
+                    self.lists,
+                    from_arg="offset",
+                    limit=limit
+                )
+            )
+        else:
+            users = [self.validate_username(user) for user in users]
+
+        scanned, selected, failed = 0, {}, []
+        for outcome in Utility.concurrent_map(
+            self.devices.lists,
+            users,
+            workers
+        ):
+            if not outcome.success or not Utility.is_success(outcome.result):
+                failed.append(outcome)
+                continue
+            scanned += 1
+            idle = [
+                device["device_id"] for device in outcome.result
+                if device.get("last_seen_ts") is not None
+                and device["last_seen_ts"] < cutoff
+            ]
+            if idle:
+                selected[outcome.item] = idle
+        if dry_run:
+            return User.DevicePruneReport(scanned, selected, 0, failed)
+
+        chunks = (
+            (userid, devices[start:start + chunk_size])
+            for userid, devices in selected.items()
+            for start in range(0, len(devices), chunk_size)
+        )
+        deleted = 0
+        for outcome in Utility.concurrent_map(
+            lambda chunk: self.devices._delete_multiple(*chunk),
+            chunks,
+            workers
+        ):
+            if outcome.success and Utility.is_success(outcome.result):
+                deleted += len(outcome.item[1])
+            else:
+                failed.append(outcome)
+        return User.DevicePruneReport(scanned, selected, deleted, failed)
+
     def deactivate(self, userid: str, erase: bool = True) -> bool:
         """Deactivate a user
 
@@ -930,6 +1089,30 @@ class _Device(Admin):
         self.server_addr = server_addr
         self.connection = conn
         self.suppress_exception = suppress_exception
+        self.deletions = None
+
+    def combine_deletions(
+        self,
+        window: float = 0.05,
+        batch_size: int = 100
+    ) -> None:
+        """Combine single device deletions of a user into one request
+
+        Once enabled, deleting one device waits up to window seconds for
+        other deletions of the same user, then all of them are sent in one
+        delete_devices request. Every caller still gets its own result.
+        Futures can be obtained directly from User.devices.deletions.submit.
+
+        Args:
+            window (float, optional): seconds to wait for other deletions, None to disable the combining. Defaults to 0.05. # noqa: E501
+            batch_size (int, optional): number of devices sent without waiting any longer. Defaults to 100. # noqa: E501
+        """
+        if self.deletions is not None:
+            self.deletions.flush()
+        if window is None:
+            self.deletions = None
+        else:
+            self.deletions = _DeviceDeletionQueue(self, window, batch_size)
 
     def lists(self, userid: str) -> list:
         """List all active devices of a user
@@ -974,6 +1157,8 @@ class _Device(Admin):
             device = device[0]
 
         userid = self.validate_username(userid)
+        if self.deletions is not None:
+            return self.deletions.submit(userid, device).result()
         resp = self.connection.request(
             "DELETE",
             self.admin_patterns(f"/users/{userid}/devices/{device}", 2)
@@ -1069,6 +1254,108 @@ class _Device(Admin):
                 raise SynapseException(data["errcode"], data["error"])
 
 
+class _DeviceDeletionQueue():
+    """Buffer device deletions per user and send them as delete_devices
+
+    The deletions of a user are sent when the first of them has waited for
+    the window, or as soon as batch_size of them are waiting. Due batches
+    are sent by one background thread, which exits when nothing is waiting,
+    a full batch is sent by the caller that filled it.
+    """
+
+    def __init__(self, devices: _Device, window: float, batch_size: int):
+        if batch_size < 1:
+            raise ValueError(
+                "Argument 'batch_size' must be a positive integer"
+            )
+        self.devices = devices
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = {}
+        self._deadlines = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self) -> int:
+        with self._condition:
+            return sum(len(batch) for batch in self._pending.values())
+
+    def submit(self, userid: str, device: str) -> Future:
+        """Queue the deletion of a device
+
+        Args:
+            userid (str): the owner of the device
+            device (str): the device you want to delete
+
+        Returns:
+            Future: resolved with the result of the delete_devices request
+        """
+        future = Future()
+        with self._condition:
+            batch = self._pending.setdefault(userid, [])
+            if not batch:
+                self._deadlines[userid] = time.monotonic() + self.window
+            batch.append((device, future))
+            if len(batch) >= self.batch_size:
+                del self._pending[userid], self._deadlines[userid]
+            else:
+                batch = None
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run,
+                        daemon=True
+                    )
+                    self._thread.start()
+                self._condition.notify()
+        if batch is not None:
+            self._send(userid, batch)
+        return future
+
+    def flush(self) -> None:
+        """Send all waiting deletions now"""
+        with self._condition:
+            batches = list(self._pending.items())
+            self._pending.clear()
+            self._deadlines.clear()
+            self._condition.notify()
+        for userid, batch in batches:
+            self._send(userid, batch)
+
+    def _send(self, userid: str, batch: list) -> None:
+        devices = list(dict.fromkeys(device for device, _ in batch))
+        try:
+            result = self.devices._delete_multiple(userid, devices)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(result)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    due = [
+                        userid for userid, deadline in self._deadlines.items()
+                        if deadline <= now
+                    ]
+                    if due:
+                        break
+                    if not self._deadlines:
+                        # Idle, the next submit starts a new thread
+                        self._thread = None
+                        return
+                    self._condition.wait(min(self._deadlines.values()) - now)
+                batches = []
+                for userid in due:
+                    batches.append((userid, self._pending.pop(userid)))
+                    del self._deadlines[userid]
+            for userid, batch in batches:
+                self._send(userid, batch)
+
+
 class _RegistrationTokens(Admin):
     def __init__(self, server_addr, conn, suppress_exception):
         self.server_addr = server_addr
@@ -1232,3 +1519,133 @@ class _RegistrationTokens(Admin):
                 return False, data
             else:
                 raise SynapseException(data["errcode"], data["error"])
+
+
+class SessionIndex(PersistentIndex):
+    """Inverted index from IP addresses and user agents to users
+
+    The connections of each user are kept as (ip, user agent, last seen)
+    triples, the IP and user agent maps are derived from them and hold the
+    last time each user was seen with that IP or user agent.
+    """
+
+    def _reset(self) -> None:
+        self._users = {}
+        self.ips = {}
+        self.user_agents = {}
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, userid: str) -> bool:
+        return userid in self._users
+
+    def users(self) -> list:
+        """List all indexed users
+
+        Returns:
+            list: user ids
+        """
+        return list(self._users)
+
+    def queried_ts(self, userid: str) -> int:
+        """Query when the sessions of a user were collected
+
+        Args:
+            userid (str): the user
+
+        Returns:
+            int: timestamp in millisecond, or None if the user is not indexed
+        """
+        user = self._users.get(userid)
+        return None if user is None else user[0]
+
+    def update(self, userid: str, connections: list, queried_ts: int) -> None:
+        """Replace the connections of a user
+
+        Args:
+            userid (str): the user
+            connections (list): connections returned by User.active_sessions
+            queried_ts (int): when the connections were collected in millisecond # noqa: E501
+        """
+        self.remove(userid)
+        triples = [
+            (c.get("ip"), c.get("user_agent"), c.get("last_seen"))
+            for c in connections
+        ]
+        self._users[userid] = (queried_ts, triples)
+        for ip, user_agent, last_seen in triples:
+            for table, key in ((self.ips, ip), (self.user_agents, user_agent)):
+                seen = table.setdefault(key, {})
+                seen[userid] = max(seen.get(userid) or 0, last_seen or 0)
+
+    def remove(self, userid: str) -> None:
+        """Remove a user from the index
+
+        Args:
+            userid (str): the user
+        """
+        user = self._users.pop(userid, None)
+        if user is None:
+            return
+        for ip, user_agent, _ in user[1]:
+            for table, key in ((self.ips, ip), (self.user_agents, user_agent)):
+                seen = table.get(key)
+                if seen is not None:
+                    seen.pop(userid, None)
+                    if not seen:
+                        del table[key]
+
+    def connections(self, userid: str) -> list:
+        """List the connections of a user
+
+        Args:
+            userid (str): the user
+
+        Returns:
+            list: (ip, user agent, last seen) triples
+        """
+        user = self._users.get(userid)
+        return [] if user is None else list(user[1])
+
+    def shared_ips(self, min_users: int = 2) -> dict:
+        """List the IP addresses used by many users
+
+        Args:
+            min_users (int, optional): minimum number of users of an IP address. Defaults to 2. # noqa: E501
+
+        Returns:
+            dict: a dict with IP address as key and a dict of user id and last seen as value, the most shared first # noqa: E501
+        """
+        return self._shared(self.ips, min_users)
+
+    def shared_user_agents(self, min_users: int = 2) -> dict:
+        """List the user agents used by many users
+
+        Args:
+            min_users (int, optional): minimum number of users of a user agent. Defaults to 2. # noqa: E501
+
+        Returns:
+            dict: a dict with user agent as key and a dict of user id and last seen as value, the most shared first # noqa: E501
+        """
+        return self._shared(self.user_agents, min_users)
+
+    @staticmethod
+    def _shared(table: dict, min_users: int) -> dict:
+        shared = [item for item in table.items() if len(item[1]) >= min_users]
+        shared.sort(key=lambda item: len(item[1]), reverse=True)
+        return dict(shared)
+
+    def _dump(self) -> dict:
+        return self._users
+
+    def _restore(self, data: dict) -> None:
+        for userid, (queried_ts, triples) in data.items():
+            self.update(
+                userid,
+                [
+                    {"ip": ip, "user_agent": user_agent, "last_seen": seen}
+                    for ip, user_agent, seen in triples
+                ],
+                queried_ts
+            )
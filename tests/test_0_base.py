@@ -26,7 +26,9 @@ import time
 from httpx import ConnectError
 from pathlib import Path
 from synapse_admin import User
-from synapse_admin.base import Admin, Client, Utility, Contents
+from synapse_admin.base import (
+    Admin, Client, Utility, Contents, SynapseException, TimeSlicer
+)
 
 
 with open("synapse_test/admin.token", "r") as f:
@@ -67,6 +69,42 @@ def test_utility_get_password(monkeypatch):
     assert Utility.get_password() == "password123"
 
 
+def test_utility_guess_type():
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "media")
+    with open(os.path.join(path, "image1.jpg"), "rb") as f:
+        assert Utility.guess_type(f.read()) == "image/jpeg"
+    ebml = b"\x1a\x45\xdf\xa3\xa3\x42\x86\x81\x01\x42\x82\x88"
+    samples = {
+        b"\x00\x00\x00\x20ftypisom\x00\x00\x02\x00": "video/mp4",
+        b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00": "image/heic",
+        b"\x00\x00\x00\x1cftypavif\x00\x00\x00\x00": "image/avif",
+        b"RIFF\x24\x00\x00\x00WEBPVP8 ": "image/webp",
+        b"RIFF\x24\x00\x00\x00WAVEfmt ": "audio/wav",
+        ebml + b"matroska": "video/x-matroska",
+        ebml + b"webm": "video/webm",
+        b"OggS\x00\x02" + b"\x00" * 22 + b"OpusHead": "audio/opus",
+        b"OggS\x00\x02" + b"\x00" * 22 + b"\x01vorbis": "audio/ogg",
+        b"fLaC\x00\x00\x00\x22": "audio/flac",
+        b"%PDF-1.7\n": "application/pdf",
+        b"PK\x03\x04\x14\x00": "application/zip",
+        b"\x89PNG\r\n\x1a\n": "image/png",
+        b"GIF89a": "image/gif",
+        b"\xff\xfb\x90\x00": "audio/mpeg",
+    }
+    for stream, mime in samples.items():
+        assert Utility.guess_type(stream) == mime
+        assert Utility.guess_type(bytearray(stream)) == mime
+        assert Utility.guess_type(memoryview(stream)) == mime
+    for magic, mime in Utility.mime_map.items():
+        assert Utility.guess_type(magic) == mime
+    assert Utility.guess_type(b"plain text") is None
+    Utility.mime_map[b"plain"] = "text/plain"
+    assert Utility.guess_type(b"plain text") == "text/plain"
+    del Utility.mime_map[b"plain"]
+    assert Utility.guess_type(b"plain text") is None
+    assert Utility.guess_type(b"") is None
+
+
 def test_base_contents():
     contens = Contents([1, 2, 3, 4], 4, 5)
     assert contens.total == 4
@@ -75,6 +113,42 @@ def test_base_contents():
         contens = Contents("Invalid")
 
 
+def test_base_time_slicer():
+    slicer = TimeSlicer(0, 1000, 100, 1.0, min_window=50, max_window=300)
+    windows = []
+    for start, end in slicer:
+        windows.append((start, end))
+        slicer.record(0.25 if len(windows) < 3 else 4.0)
+    assert windows[:4] == [(0, 100), (100, 300), (300, 600), (600, 750)]
+    assert windows[-1][1] == 1000 and slicer.position == 1000
+    slicer = TimeSlicer(0, 1000, 100, 1.0, min_window=1)
+    for start, _ in slicer:
+        if start == 200:
+            break
+        slicer.record(1.0)
+    assert slicer.position == 200
+    with pytest.raises(ValueError):
+        TimeSlicer(0, 1000, 0, 1.0)
+
+
+def test_base_paginate():
+    def pages(_from=0, limit=3):
+        items = list(range(10))[_from:_from + limit]
+        nxt = _from + limit if _from + limit < 10 else None
+        return Contents(items, 10, nxt)
+
+    assert list(base_handler._paginate(pages)) == list(range(10))
+    pages_read_ahead = base_handler._paginate(pages, read_ahead=True)
+    assert list(pages_read_ahead) == list(range(10))
+    assert list(base_handler._paginate(lambda _from: None)) == []
+    with pytest.raises(SynapseException):
+        list(base_handler._paginate(lambda _from: (False, {})))
+    failed = (False, "M_LIMIT_EXCEEDED", "Too many requests")
+    with pytest.raises(SynapseException) as e:
+        list(base_handler._paginate(lambda _from: failed))
+    assert e.value.code == "M_LIMIT_EXCEEDED"
+
+
 def test_base_create_config():
     """TODO: interactive"""
     base_handler.config_path = config_path
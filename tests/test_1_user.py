@@ -87,6 +87,19 @@ def test_user_active_session():
     assert user_handler.active_sessions("test2") == []
 
 
+def test_user_session_index(tmp_path):
+    path = str(tmp_path / "sessions.json")
+    index = user_handler.session_index(path)
+    assert "@test2:localhost" in index
+    assert index.connections("@test2:localhost") == []
+    assert len(index) == len(user_handler.lists())
+    queried = index.queried_ts("@test2:localhost")
+    index = user_handler.session_index(path)
+    assert index.queried_ts("@test2:localhost") == queried
+    index = user_handler.session_index(path, ["test2"])
+    assert index.queried_ts("@test2:localhost") >= queried
+
+
 def test_user_deactivate():
     assert user_handler.deactivate("test2")
     with pytest.raises(SynapseException):
@@ -291,6 +304,17 @@ def test_user_device_show():
         assert user_handler.devices.show("invalid", target)
 
 
+def test_user_prune_devices():
+    report = user_handler.prune_devices(0, ["test2"], dry_run=True)
+    assert report.users == 1 and report.deleted == 0
+    assert len(report.selected["@test2:localhost"]) == 4
+    report = user_handler.prune_devices(36500, ["test2"])
+    assert report.selected == {} and report.deleted == 0
+    report = user_handler.prune_devices(0, ["invalid"], dry_run=True)
+    assert report.users == 0 and len(report.failed) == 1
+    assert len(user_handler.devices.lists("test2")) == 4
+
+
 def test_user_device_delete():
     devices = user_handler.devices.lists("test2")
     assert user_handler.devices.delete("test2", devices[0]["device_id"])
@@ -311,6 +335,30 @@ def test_user_device_delete_multiple():
         user_handler.devices.delete("invalid", ["invalid", "invalid2"])
 
 
+def test_user_device_combine_deletions():
+    for _ in range(3):
+        ClientAPI.admin_login(
+            "http://",
+            "localhost",
+            8008,
+            "test2",
+            "12345678",
+            no_admin=True
+        )
+    devices = [d["device_id"] for d in user_handler.devices.lists("test2")]
+    assert len(devices) == 3
+    user_handler.devices.combine_deletions(0.1)
+    futures = [
+        user_handler.devices.deletions.submit("@test2:localhost", device)
+        for device in devices[:2]
+    ]
+    assert [future.result() for future in futures] == [True, True]
+    assert user_handler.devices.delete("test2", devices[2])
+    user_handler.devices.combine_deletions(None)
+    assert user_handler.devices.deletions is None
+    assert user_handler.devices.lists("test2") == []
+
+
 def test_user_username_available():
     assert not user_handler.username_available("test2")
     assert user_handler.username_available("test4")
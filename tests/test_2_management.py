@@ -22,8 +22,10 @@ SOFTWARE."""
 
 import pytest
 import time
+from datetime import datetime, time as day_time
 from synapse_admin import Management, Room, User
 from synapse_admin.base import HTTPConnection, SynapseException, Utility
+from synapse_admin.management import BackgroundUpdateMonitor, EventReportIndex
 from uuid import uuid4
 
 
@@ -61,12 +63,51 @@ def test_management_announce():
     assert isinstance(mgt_handler.announce("admin1", "This is a test"), str)
 
 
+def test_management_announce_attachment():
+    image = "tests/media/image1.jpg"
+    uploaded = user_handler.list_media("admin1").total
+    events = mgt_handler.announce("test1", "This is a test", image)
+    assert len(events) == 2 and all(isinstance(event, str) for event in events)
+    with open("tests/media/image1.jpg", "rb") as f:
+        event = mgt_handler.announce("test1", attachment=f.read())
+        assert isinstance(event, str)
+    # The same content is uploaded only once
+    assert user_handler.list_media("admin1").total == uploaded + 1
+    with pytest.raises(ValueError):
+        mgt_handler.announce(False, "This is a test")
+
+
 def test_management_announce_all():
     announcement = mgt_handler.announce_all("This is a test")
     assert isinstance(announcement, dict)
     assert len(announcement) == 4
 
 
+def test_management_announce_all_attachment():
+    image = "tests/media/image1.jpg"
+    uploaded = user_handler.list_media("admin1").total
+    announcement = mgt_handler.announce(True, "This is a test", image)
+    assert len(announcement) == 4
+    assert all(len(events) == 2 for events in announcement.values())
+    assert user_handler.list_media("admin1").total == uploaded
+
+
+def test_management_announce_all_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / "announce.txt")
+    announcement = mgt_handler.announce_all(
+        "This is a test",
+        checkpoint=checkpoint
+    )
+    assert len(announcement) == 4
+    with open(checkpoint, "r") as f:
+        assert set(f.read().split()) == set(announcement)
+    announcement = mgt_handler.announce_all(
+        "This is a test",
+        checkpoint=checkpoint
+    )
+    assert announcement == {}
+
+
 def test_management_version():
     version = mgt_handler.version()
     assert hasattr(version, "server") and hasattr(version, "python")
@@ -109,6 +150,20 @@ def test_management_specific_event_report():
         mgt_handler.specific_event_report(1)
 
 
+def test_management_triage_event_reports(tmp_path):
+    path = str(tmp_path / "reports.json")
+    index = EventReportIndex(path)
+    reports = mgt_handler.triage_event_reports(index)
+    assert len(reports) == 1 and "event_json" in reports[0]
+    assert index.last_id == 2 and index.pending == []
+    assert index.reporters["@test2:localhost"] == 1
+    assert index.senders["@test1:localhost"] == 1
+    assert index.score_distribution("@test1:localhost") == {-100: 1}
+    index = EventReportIndex(path)
+    assert mgt_handler.triage_event_reports(index) == []
+    assert len(index) == 1
+
+
 def test_management_purge_history():
     global shared_variable
     roomid, eventid = shared_variable
@@ -138,6 +193,35 @@ def test_management_purge_history_status():
         mgt_handler.purge_history_status("invalid")
 
 
+def test_management_purge_history_all():
+    roomid, _ = room_handler.create(False, members=["test1"])
+    results = mgt_handler.purge_history_all(
+        Utility.get_current_time(),
+        [roomid, "!invalid:localhost"],
+        True,
+        poll_interval=0.1
+    )
+    assert results[roomid].status == "complete"
+    assert isinstance(results[roomid].purge_id, str)
+    assert results["!invalid:localhost"].status == "error"
+    room_handler.delete(roomid)
+
+
+def test_management_purge_history_sliced():
+    roomid, _ = room_handler.create(False, members=["test1"])
+    now = Utility.get_current_time()
+    purge = mgt_handler.purge_history_sliced(
+        roomid,
+        now,
+        True,
+        window=1000,
+        poll_interval=0.1
+    )
+    assert purge.complete and purge.error is None and purge.position == now
+    assert len(purge.windows) > 0 and purge.windows[-1][0] == now
+    room_handler.delete(roomid)
+
+
 def test_management_background_updates_get():
     enabled, _ = mgt_handler.background_updates_get()
     assert enabled
@@ -153,6 +237,24 @@ def test_management_background_updates_set():
     assert enabled
 
 
+def test_management_background_update_monitor():
+    monitor = BackgroundUpdateMonitor(mgt_handler)
+    assert isinstance(monitor.run(interval=0.1, samples=2), dict)
+    assert monitor.enabled
+    monitor = BackgroundUpdateMonitor(
+        mgt_handler,
+        windows=[(day_time(22, 0), day_time(6, 0))]
+    )
+    assert monitor.in_window(datetime(2022, 1, 1, 23, 30))
+    assert not monitor.in_window(datetime(2022, 1, 1, 12, 0))
+    assert not monitor.apply_window(datetime(2022, 1, 1, 12, 0))
+    enabled, _ = mgt_handler.background_updates_get()
+    assert not enabled
+    assert monitor.apply_window(datetime(2022, 1, 1, 3, 0))
+    enabled, _ = mgt_handler.background_updates_get()
+    assert enabled
+
+
 def todo_test_management_federation_list():
     ...
 
@@ -162,6 +264,30 @@ def test_management_reset_connection():
         mgt_handler.reset_connection("matrix.org")
 
 
+def test_management_federation_health():
+    health = mgt_handler.federation_health()
+    assert set(health.classes) == {"healthy", "backoff", "retrying", "dead"}
+    assert health.total == sum(len(v) for v in health.classes.values())
+    assert len(health.worst) <= 10
+
+
+def test_management_reset_connections():
+    outcomes = mgt_handler.reset_connections(["matrix.org"])
+    assert len(outcomes) == 1 and not outcomes[0].success
+    assert isinstance(outcomes[0].result, SynapseException)
+
+
 def test_management_federation_room():
     with pytest.raises(SynapseException):
         mgt_handler.federation_room("matrix.org", _dir="b")
+
+
+def test_management_federation_room_map(tmp_path):
+    path = str(tmp_path / "federation.json")
+    index = mgt_handler.federation_room_map(path)
+    assert len(index) == mgt_handler.federation_health().total
+    assert index.counts() == {
+        destination: len(index.rooms_of(destination))
+        for destination in index.destinations()
+    }
+    assert mgt_handler.federation_room_map(path).counts() == index.counts()
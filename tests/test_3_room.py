@@ -22,7 +22,8 @@ SOFTWARE."""
 
 import pytest
 from synapse_admin.base import SynapseException, HTTPConnection
-from synapse_admin import Room
+from synapse_admin import Mirror, Room
+from synapse_admin.room import RoomStateStore
 
 
 with open("synapse_test/admin.token", "r") as f:
@@ -92,16 +93,51 @@ def test_room_forward_extremities_delete():
     assert len(room_handler.forward_extremities_check(roomid)) == 1
 
 
+def test_room_forward_extremities_audit():
+    report = room_handler.forward_extremities_audit()
+    assert len(report.before) == len(room_handler.lists())
+    assert report.deleted == {} and report.failed == []
+    counts = [count for _, count in report.before]
+    assert counts == sorted(counts, reverse=True)
+    report = room_handler.forward_extremities_audit(0, pause=0)
+    assert report.deleted == {roomid: 0 for roomid, _ in report.before}
+    assert set(report.after) == set(report.deleted)
+
+
+def test_room_membership_graph():
+    roomid, joined = room_handler.create(
+        True,
+        alias="membership",
+        name="Membership",
+        members=["test1", "test2"],
+        federation=False
+    )
+    assert joined == ["@test1:localhost", "@test2:localhost"]
+    graph, failed = room_handler.membership_graph()
+    assert failed == [] and len(graph.rooms) == len(room_handler.lists())
+    assert graph.members(roomid) == room_handler.list_members(roomid)
+    assert roomid in graph.rooms_of("@test1:localhost")
+    assert graph.degree("@test1:localhost") > 0
+    assert roomid in graph.shared_rooms("@test1:localhost", "@test2:localhost")
+    neighbours = graph.neighbours("@test1:localhost")
+    assert neighbours["@test2:localhost"] > 0
+    assert "@test1:localhost" not in neighbours
+
+
 def test_room_create():
     """TODO: test encryption"""
-    roomid, _ = room_handler.create(
+    information = room_handler.create(
         True,
         alias="testing",
         name="Testing",
-        members=["test1"],
+        members=["test1", "invalid"],
         federation=False,
         leave=True
     )
+    roomid, joined = information
+    assert joined == ["@test1:localhost"]
+    failed = information.failed
+    assert len(failed) == 1 and failed[0].item == "@invalid:localhost"
     global shared_variable
     shared_variable = roomid
     room = room_handler.details(roomid)
@@ -237,3 +273,116 @@ def test_room_block_status():
     assert room_handler.block_status(shared_variable)
     assert not room_handler.block(shared_variable, False)
     assert not room_handler.block_status(shared_variable)
+
+
+def test_room_provision():
+    specs = {
+        "team1": {"name": "Team 1", "members": ["test1", "test2"]},
+        "team2": {
+            "alias": "team2",
+            "members": ["test1", "invalid"],
+            "encrypted": False,
+            "leave": True
+        }
+    }
+    rooms = room_handler.provision(specs, workers=2)
+    assert list(rooms) == ["team1", "team2"]
+    assert rooms["team1"].joined == ["@test1:localhost", "@test2:localhost"]
+    assert rooms["team2"].joined == ["@test1:localhost"]
+    assert rooms["team2"].failed[0].item == "@invalid:localhost"
+    members = room_handler.list_members(rooms["team2"].roomid)
+    assert members == ["@test1:localhost"]
+    for room in rooms.values():
+        room_handler.delete(room.roomid)
+
+    with pytest.raises(ValueError):
+        room_handler.provision([{"name": "Alone", "leave": True}])
+
+
+def test_room_deletions():
+    roomids = [create_room("testing3"), create_room("testing4")]
+    finished = []
+    futures = room_handler.deletions.submit_many(
+        roomids,
+        callback=finished.append,
+        purge=True
+    )
+    assert sorted(futures) == sorted(roomids)
+    assert room_handler.deletions.wait(60)
+    assert len(finished) == 2 and len(room_handler.deletions) == 0
+    for future in futures.values():
+        assert future.result()["status"] == "complete"
+    with pytest.raises(SynapseException):
+        room_handler.deletions.submit("invalid").result()
+
+
+def test_room_refresh_state(tmp_path):
+    path = str(tmp_path / "state.json.gz")
+    roomid = create_room("testing5")
+    store = RoomStateStore(path)
+    diffs = room_handler.refresh_state(store, [roomid])
+    assert len(diffs[roomid].added) > 0 and diffs[roomid].changed == []
+    assert store.get(roomid, "m.room.create")["creator"] == "@admin1:localhost"
+    assert roomid in store.rooms_with_power_level("@admin1:localhost", 100)
+
+    assert room_handler.set_admin(roomid, "test1")
+    store = RoomStateStore(path)
+    diffs = room_handler.refresh_state(store, [roomid])
+    changed = [new["type"] for _, new in diffs[roomid].changed]
+    assert "m.room.power_levels" in changed
+    assert roomid in store.rooms_with_power_level("@test1:localhost", 100)
+    assert room_handler.refresh_state(store, [roomid]) == {}
+    room_handler.delete(roomid)
+
+
+def test_room_mirror(tmp_path):
+    roomid = create_room("testing6")
+    with Mirror(str(tmp_path / "mirror.db"), room_handler) as mirror:
+        report = mirror.sync()
+        assert report.users > 0 and report.rooms > 0
+        assert report.failed_rooms == []
+        assert mirror.query(
+            "SELECT user_id FROM memberships WHERE room_id = ?",
+            (roomid,)
+        ) == [("@test1:localhost",)]
+        assert "@test1:localhost" in mirror.users_in_many_rooms(0)
+        report = mirror.sync()
+        assert report.refreshed_rooms == 0 and report.removed_rooms == 0
+        room_handler.delete(roomid)
+        assert mirror.sync().removed_rooms == 1
+        assert mirror.query(
+            "SELECT * FROM rooms WHERE room_id = ?",
+            (roomid,)
+        ) == []
+
+
+def test_room_reap_empty_rooms():
+    roomid = create_room("testing7")
+    test1_conn.request("POST", f"/_matrix/client/r0/rooms/{roomid}/leave", {})
+    report = room_handler.reap_empty_rooms(dry_run=True)
+    assert roomid in report.candidates and report.deleted == []
+    keep = [room for room in report.candidates if room != roomid]
+    report = room_handler.reap_empty_rooms(keep=keep)
+    assert report.candidates == [roomid] and report.deleted == [roomid]
+    assert report.failed == {} and report.pending == []
+    with pytest.raises(SynapseException):
+        room_handler.details(roomid)
+
+
+def test_room_reap_empty_rooms_sorted():
+    # By name, the populated room is listed before the empty one
+    populated, _ = room_handler.create(
+        name="Zz populated",
+        members=["test1"],
+        federation=False,
+        leave=True
+    )
+    empty, _ = room_handler.create(
+        name="Aa empty",
+        members=["test1"],
+        federation=False,
+        leave=True
+    )
+    test1_conn.request("POST", f"/_matrix/client/r0/rooms/{empty}/leave", {})
+    report = room_handler.reap_empty_rooms(dry_run=True)
+    assert empty in report.candidates and populated not in report.candidates
@@ -160,12 +160,47 @@ def test_media_statistics():
         media_handler.statistics(orderby="invalid")
 
 
+def test_media_usage_report():
+    report = media_handler.usage_report(top=1, limit=1)
+    assert report.users == 2
+    assert report.media_count == 5
+    assert report.media_length == 1418007 + 10761727
+    assert report.top_length == [(10761727, "@admin1:localhost")]
+    assert report.top_count == [(3, "@admin1:localhost")]
+    assert sum(report.count_histogram.values()) == 2
+    assert report.length_histogram == {2097152: 1, 16777216: 1}
+
+    reports = media_handler.usage_report_windows(
+        0,
+        Utility.get_current_time(),
+        Utility.get_current_time() // 2 + 1
+    )
+    assert len(reports) == 2
+    assert reports[1].users == 2
+
+    with pytest.raises(ValueError):
+        media_handler.usage_report(top=0)
+
+
 def test_media_list_media():
     assert post_media()
     returned = media_handler.list_media(reference_room).local
     assert sorted(returned) == sorted(media_id[:2])
 
 
+def test_media_media_inventory(tmp_path):
+    path = str(tmp_path / "inventory.json")
+    inventory = media_handler.media_inventory(path)
+    assert os.path.isfile(path)
+    assert sorted(inventory.media_in(reference_room)) == sorted(media_id[:2])
+    assert inventory.rooms_with(media_id[0]) == [reference_room]
+    assert inventory.counts()[reference_room] == (2, 0)
+
+    inventory = media_handler.media_inventory(path, rooms=[reference_room])
+    assert inventory.rooms_with(media_id[1]) == [reference_room]
+    assert media_id[2] not in inventory
+
+
 def test_media_protect_media():
     protected_media = media_id[0]
     assert query_media(protected_media).status_code == 200
@@ -217,6 +252,23 @@ def test_media_quarantine_remove():
     assert query_media(quarantined_media).status_code == 200
 
 
+def test_media_quarantine_ids():
+    batch = media_id[2:4]
+    outcomes = media_handler.quarantine_remove_ids(batch)
+    assert sorted(outcome.item for outcome in outcomes) == sorted(batch)
+    assert all(outcome.success for outcome in outcomes)
+    for media in batch:
+        assert query_media(media).status_code == 200
+
+    outcomes = media_handler.quarantine_ids(iter(batch), workers=1)
+    assert all(outcome.success for outcome in outcomes)
+    for media in batch:
+        assert query_media(media).status_code == 404
+
+    with pytest.raises(TypeError):
+        media_handler.quarantine_ids(batch[0])
+
+
 def test_media_delete_local_media():
     delete_media = media_id[0]
     assert media_handler.delete_local_media(delete_media)
@@ -230,6 +282,30 @@ def test_media_purge_remote_media():
     assert media_handler.purge_remote_media() == 0
 
 
+def test_media_purge_remote_media_sliced():
+    purge = media_handler.purge_remote_media_sliced(Utility.get_current_time())
+    assert purge.complete and purge.deleted == 0 and purge.error is None
+
+
+def test_media_delete_local_media_sliced(tmp_path):
+    checkpoint = str(tmp_path / "delete.json")
+    now = Utility.get_current_time()
+    deletion = media_handler.delete_local_media_sliced(
+        now,
+        1000000000,
+        checkpoint=checkpoint
+    )
+    assert deletion.complete and deletion.deleted == 0
+    assert deletion.position == now and os.path.isfile(checkpoint)
+    assert os.path.isfile(f"{checkpoint}.media")
+    deletion = media_handler.delete_local_media_sliced(
+        now + 1000,
+        1000000000,
+        checkpoint=checkpoint
+    )
+    assert deletion.complete and deletion.position == now + 1000
+
+
 def test_media_delete_media():
     assert media_handler.delete_media(size_gt=1000000000) == []
     assert media_handler.delete_media(media_id[2])
@@ -293,3 +369,25 @@ def test_media_delete_media_by_user():
 
     with pytest.raises(SynapseException):
         media_handler.delete_media_by_user("invalid")
+
+
+def test_media_retention():
+    assert upload_media()
+    before_ts = Utility.get_current_time(10000)
+    plan = media_handler.retention_plan(before_ts, 9000000, ["test1"])
+    assert plan.count == 1 and list(plan.media) == ["@admin1:localhost"]
+    assert plan.length > 9000000
+    assert media_handler.retention_plan(before_ts, 0, ["test1"]).count == 3
+    plan_all = media_handler.retention_plan(before_ts, 0, ["test1"], False)
+    assert plan_all.count == 3
+    assert media_handler.retention_plan(0).count == 0
+
+    report = media_handler.retention_execute(plan)
+    assert report.failed == [] and report.length == plan.length
+    assert report.deleted == [plan.media["@admin1:localhost"][0][0]]
+    assert media_handler.retention_plan(before_ts, 9000000).count == 0
+
+    media_handler.delete_media_by_user("admin1")
+    media_handler.delete_media_by_user("test1")
+    with pytest.raises(ValueError):
+        media_handler.retention_plan(before_ts, -1)